@@ -11,18 +11,26 @@ Author: AI Assistant
 """
 
 import sys
+import os
+import argparse
+import json
+import queue
+import tempfile
+import threading
 import cv2
 import numpy as np
 from typing import Optional, Tuple
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import time
 
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
     QLabel, QPushButton, QGroupBox, QGridLayout, QComboBox, QSpinBox,
-    QMessageBox, QFileDialog, QSlider, QCheckBox
+    QMessageBox, QFileDialog, QSlider, QCheckBox, QInputDialog
 )
-from PyQt5.QtCore import Qt, QTimer, pyqtSignal, QThread
-from PyQt5.QtGui import QImage, QPixmap
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal, QThread, QRectF
+from PyQt5.QtGui import QImage, QPixmap, QPainter, QColor, QPen
 
 
 # ============================================================================
@@ -38,18 +46,18 @@ class ImageCorrector:
         self.contrast = 0    # -50 to +50
         self.sharpness = 0   # 0 to 100
         
-        # Pre-computed masks (3 channel)
-        self._vignette_mask_3ch = None
-        self._mask_size = None
+        # Pre-computed masks (3 channel), one per frame size
+        self._vignette_masks = {}
         
         # LUT for brightness/contrast (much faster)
         self._lut = None
         self._lut_params = None
         
     def _create_vignette_mask_3ch(self, h: int, w: int) -> np.ndarray:
-        """Tạo mask 3 channel (pre-computed, chỉ tạo 1 lần)"""
-        if self._vignette_mask_3ch is not None and self._mask_size == (h, w):
-            return self._vignette_mask_3ch
+        """Tạo mask 3 channel (pre-computed, chỉ tạo 1 lần cho mỗi kích thước)"""
+        mask = self._vignette_masks.get((h, w))
+        if mask is not None:
+            return mask
             
         # Downscale for speed, then upscale
         scale = 0.25
@@ -69,9 +77,9 @@ class ImageCorrector:
         vignette = cv2.resize(vignette.astype(np.float32), (w, h))
         
         # Stack to 3 channels
-        self._vignette_mask_3ch = np.dstack([vignette, vignette, vignette])
-        self._mask_size = (h, w)
-        return self._vignette_mask_3ch
+        mask = np.dstack([vignette, vignette, vignette])
+        self._vignette_masks[(h, w)] = mask
+        return mask
         
     def _create_lut(self, brightness: int, contrast: int) -> np.ndarray:
         """Create lookup table for fast brightness/contrast"""
@@ -90,6 +98,21 @@ class ImageCorrector:
         self._lut_params = params
         return self._lut
         
+    def get_params(self) -> dict:
+        """Tham số hiệu chỉnh hiện tại (lưu kèm tile trong archive)"""
+        return {
+            "vignette_correction": self.vignette_correction,
+            "brightness": self.brightness,
+            "contrast": self.contrast,
+            "sharpness": self.sharpness,
+        }
+        
+    def set_params(self, params: dict):
+        """Áp dụng tham số hiệu chỉnh (vd. đọc từ archive)"""
+        for key in ("vignette_correction", "brightness", "contrast", "sharpness"):
+            if key in params:
+                setattr(self, key, params[key])
+        
     def correct(self, frame: np.ndarray) -> np.ndarray:
         """Apply corrections - OPTIMIZED"""
         
@@ -123,6 +146,561 @@ class ImageCorrector:
         return result
 
 
+# ============================================================================
+# CANVAS BLOCK STORE - Lưu canvas theo block nén + LRU cache
+# ============================================================================
+
+# Canvas block codecs: name -> (extension, imencode params)
+CANVAS_CODECS = {
+    "PNG nhanh (lossless)": (".png", [cv2.IMWRITE_PNG_COMPRESSION, 1]),
+    "JPEG 95 (lossy)": (".jpg", [cv2.IMWRITE_JPEG_QUALITY, 95]),
+    "Không nén": (None, None),
+}
+
+CANVAS_BLOCK_SIZE = 512      # pixels per block side
+CANVAS_CACHE_BLOCKS = 96     # decoded hot blocks (~75MB at 512px BGR)
+
+
+class CanvasBlockStore:
+    """
+    Canvas thưa chia thành các block vuông.
+    Block "nóng" (gần vị trí hiện tại) giữ dạng đã giải nén trong LRU cache,
+    block "nguội" được nén (PNG/JPEG) trong RAM.
+    Toạ độ là toạ độ thế giới (có thể âm), không cần offset hay mở rộng canvas.
+    """
+    
+    def __init__(self, block_size: int = CANVAS_BLOCK_SIZE,
+                 cache_blocks: int = CANVAS_CACHE_BLOCKS,
+                 codec: str = "PNG nhanh (lossless)"):
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self.codec = codec
+        
+        self._hot = OrderedDict()   # (bx, by) -> decoded BGR block
+        self._dirty = set()         # hot blocks changed since last encode
+        self._cold = OrderedDict()  # (bx, by) -> (ext, payload), least recently used first
+        self._cold_bytes = 0
+        self._spilled = {}          # (bx, by) -> (ext, offset, nbytes) in spill file
+        self._spill_file = None
+        self._spill_end = 0         # spill file size
+        self._spill_free = []       # sorted free (offset, nbytes) extents for reuse
+        self.spilled_bytes = 0      # live spilled payload bytes
+        self._lock = threading.RLock()  # viewer tiles are read from a background thread
+        
+        # Stats
+        self.decodes = 0
+        self.encodes = 0
+    
+    def reset(self):
+        with self._lock:
+            self._hot.clear()
+            self._dirty.clear()
+            self._cold.clear()
+            self._cold_bytes = 0
+            self._spilled.clear()
+            if self._spill_file is not None:
+                self._spill_file.close()
+                self._spill_file = None
+            self._spill_end = 0
+            self._spill_free = []
+            self.spilled_bytes = 0
+            self.decodes = 0
+            self.encodes = 0
+    
+    def _encode(self, key, block: np.ndarray):
+        """Nén block và chuyển sang vùng nguội"""
+        ext, params = CANVAS_CODECS.get(self.codec, (None, None))
+        if ext is None:
+            payload = block
+        else:
+            ok, buf = cv2.imencode(ext, block, params)
+            payload = buf if ok else block
+            if not ok:
+                ext = None
+        
+        old = self._cold.pop(key, None)
+        if old is not None:
+            self._cold_bytes -= old[1].nbytes
+        self._free_spilled(key)  # old spilled copy is stale
+        self._cold[key] = (ext, payload)
+        self._cold_bytes += payload.nbytes
+        self.encodes += 1
+    
+    def _evict(self):
+        """Đẩy block ít dùng nhất ra khỏi cache (nén nếu đã thay đổi)"""
+        while len(self._hot) > self.cache_blocks:
+            key, block = self._hot.popitem(last=False)
+            if key in self._dirty:
+                self._dirty.discard(key)
+                self._encode(key, block)
+    
+    def _get_block(self, key, create: bool = False) -> Optional[np.ndarray]:
+        """Lấy block đã giải nén qua LRU cache"""
+        block = self._hot.get(key)
+        if block is not None:
+            self._hot.move_to_end(key)
+            return block
+        
+        cold = self._cold.get(key)
+        spilled = self._spilled.get(key)
+        if cold is not None:
+            self._cold.move_to_end(key)
+            ext, payload = cold
+            if ext is None:
+                block = payload.copy()
+            else:
+                block = cv2.imdecode(payload, cv2.IMREAD_COLOR)
+            self.decodes += 1
+        elif spilled is not None:
+            ext, offset, nbytes = spilled
+            self._spill_file.seek(offset)
+            data = np.frombuffer(bytearray(self._spill_file.read(nbytes)), dtype=np.uint8)
+            if ext is None:
+                bs = self.block_size
+                block = data.reshape(bs, bs, 3)
+            else:
+                block = cv2.imdecode(data, cv2.IMREAD_COLOR)
+            self.decodes += 1
+        elif create:
+            bs = self.block_size
+            block = np.zeros((bs, bs, 3), dtype=np.uint8)
+        else:
+            return None
+        
+        self._hot[key] = block
+        self._evict()
+        return block
+    
+    def evict_hot(self, nbytes: int, keep: int = 4) -> int:
+        """
+        Giải phóng ~nbytes bằng cách nén các block nóng ít dùng nhất
+        (giữ lại keep block gần nhất). Trả về số byte giải phóng.
+        """
+        with self._lock:
+            block_bytes = self.block_size * self.block_size * 3
+            freed = 0
+            while freed < nbytes and len(self._hot) > keep:
+                key, block = self._hot.popitem(last=False)
+                before = self._cold_bytes
+                if key in self._dirty:
+                    self._dirty.discard(key)
+                    self._encode(key, block)
+                freed += block_bytes - (self._cold_bytes - before)
+            return freed
+    
+    def _free_spilled(self, key):
+        """Bỏ bản spill của block (đã cũ) và trả chỗ trong file để dùng lại"""
+        old = self._spilled.pop(key, None)
+        if old is None:
+            return
+        _, offset, nbytes = old
+        self.spilled_bytes -= nbytes
+        
+        # Insert and merge with neighbouring free extents
+        free = self._spill_free
+        free.append((offset, nbytes))
+        free.sort()
+        merged = [free[0]]
+        for off, n in free[1:]:
+            last_off, last_n = merged[-1]
+            if last_off + last_n == off:
+                merged[-1] = (last_off, last_n + n)
+            else:
+                merged.append((off, n))
+        # A free tail shrinks the file
+        if merged[-1][0] + merged[-1][1] == self._spill_end:
+            self._spill_end = merged.pop()[0]
+            self._spill_file.truncate(self._spill_end)
+        self._spill_free = merged
+    
+    def _spill_alloc(self, nbytes: int) -> int:
+        """Offset cho payload nbytes: extent trống đầu tiên đủ lớn, nếu không thì cuối file"""
+        for i, (off, n) in enumerate(self._spill_free):
+            if n >= nbytes:
+                if n == nbytes:
+                    del self._spill_free[i]
+                else:
+                    self._spill_free[i] = (off + nbytes, n - nbytes)
+                return off
+        offset = self._spill_end
+        self._spill_end += nbytes
+        return offset
+    
+    def _compact_spill(self):
+        """Ghi lại các block còn dùng vào file mới, liền nhau"""
+        new_file = tempfile.TemporaryFile(prefix="pathocam_spill_")
+        offset = 0
+        for key, (ext, old_offset, nbytes) in self._spilled.items():
+            self._spill_file.seek(old_offset)
+            new_file.write(self._spill_file.read(nbytes))
+            self._spilled[key] = (ext, offset, nbytes)
+            offset += nbytes
+        self._spill_file.close()
+        self._spill_file = new_file
+        self._spill_end = offset
+        self._spill_free = []
+    
+    def spill(self, nbytes: int) -> int:
+        """
+        Chuyển ~nbytes block nén ít dùng nhất từ RAM ra file tạm.
+        Trả về số byte giải phóng.
+        """
+        with self._lock:
+            if self._spill_file is None:
+                self._spill_file = tempfile.TemporaryFile(prefix="pathocam_spill_")
+            elif self._spill_end - self.spilled_bytes > self.spilled_bytes:
+                # More dead space than live data
+                self._compact_spill()
+            freed = 0
+            for key in list(self._cold):
+                if freed >= nbytes:
+                    break
+                ext, payload = self._cold.pop(key)
+                offset = self._spill_alloc(payload.nbytes)
+                self._spill_file.seek(offset)
+                self._spill_file.write(payload.tobytes())
+                self._spilled[key] = (ext, offset, payload.nbytes)
+                self._cold_bytes -= payload.nbytes
+                self.spilled_bytes += payload.nbytes
+                freed += payload.nbytes
+            return freed
+    
+    def _block_range(self, x: int, y: int, w: int, h: int):
+        bs = self.block_size
+        for by in range(y // bs, (y + h - 1) // bs + 1):
+            for bx in range(x // bs, (x + w - 1) // bs + 1):
+                yield bx, by
+    
+    def write(self, x: int, y: int, img: np.ndarray):
+        """Ghi ảnh BGR vào canvas tại (x, y) (ghi đè)"""
+        with self._lock:
+            h, w = img.shape[:2]
+            bs = self.block_size
+            
+            for bx, by in self._block_range(x, y, w, h):
+                bx0, by0 = bx * bs, by * bs
+                # Intersection in world coordinates
+                x1, y1 = max(x, bx0), max(y, by0)
+                x2, y2 = min(x + w, bx0 + bs), min(y + h, by0 + bs)
+                
+                block = self._get_block((bx, by), create=True)
+                block[y1-by0:y2-by0, x1-bx0:x2-bx0] = img[y1-y:y2-y, x1-x:x2-x]
+                self._dirty.add((bx, by))
+    
+    def read(self, x: int, y: int, w: int, h: int) -> np.ndarray:
+        """Đọc vùng (x, y, w, h) qua cache; vùng trống trả về 0"""
+        with self._lock:
+            out = np.zeros((h, w, 3), dtype=np.uint8)
+            if w <= 0 or h <= 0:
+                return out
+            bs = self.block_size
+            
+            for bx, by in self._block_range(x, y, w, h):
+                block = self._get_block((bx, by))
+                if block is None:
+                    continue
+                bx0, by0 = bx * bs, by * bs
+                x1, y1 = max(x, bx0), max(y, by0)
+                x2, y2 = min(x + w, bx0 + bs), min(y + h, by0 + bs)
+                out[y1-y:y2-y, x1-x:x2-x] = block[y1-by0:y2-by0, x1-bx0:x2-bx0]
+            
+            return out
+    
+    def get_stats(self) -> dict:
+        """Thống kê bộ nhớ: RAM thực tế và tỉ lệ nén"""
+        with self._lock:
+            block_bytes = self.block_size * self.block_size * 3
+            cold_only = [k for k in self._cold if k not in self._hot]
+            cold_raw = len(cold_only) * block_bytes
+            cold_bytes = sum(self._cold[k][1].nbytes for k in cold_only)
+            hot_bytes = len(self._hot) * block_bytes
+            
+            return {
+                "blocks": len(set(self._hot) | set(self._cold) | set(self._spilled)),
+                "hot_blocks": len(self._hot),
+                "hot_bytes": hot_bytes,
+                "cold_bytes": self._cold_bytes,
+                "ram_bytes": hot_bytes + self._cold_bytes,
+                "spilled_bytes": self.spilled_bytes,
+                "ratio": cold_raw / cold_bytes if cold_bytes > 0 else 1.0,
+            }
+
+
+# ============================================================================
+# VIEW TILE CACHE - Tile hiển thị nhiều mức cho canvas viewer
+# ============================================================================
+
+VIEW_TILE_SIZE = 256     # display tile side (pixels at its level)
+VIEW_CACHE_TILES = 384   # ~75MB of 256px BGR tiles
+VIEW_MAX_LEVEL = 8       # level k = scale 1/2^k
+VIEW_LEVEL_BLOCKS = 32   # decoded blocks kept per pyramid level
+VIEW_LEVEL_CODEC = "JPEG 95 (lossy)"  # levels >= 1 are display-only
+
+
+class CanvasTileCache:
+    """
+    Tile hiển thị nhiều mức (level k = canvas thu nhỏ 1/2^k).
+    Level 0 đọc từ block store của canvas; level k >= 1 được lưu sẵn trong
+    CanvasBlockStore riêng (block JPEG, một block = một tile) và cập nhật
+    tăng dần mỗi khi add_tile ghi tile mới, nên không phải dựng lại từ level 0.
+    Tile hiển thị giữ trong LRU; tile thiếu được nạp trên background thread.
+    """
+    
+    def __init__(self, store: CanvasBlockStore, tile_size: int = VIEW_TILE_SIZE,
+                 max_tiles: int = VIEW_CACHE_TILES, max_level: int = VIEW_MAX_LEVEL):
+        self.store = store
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.max_level = max_level
+        
+        # levels[k]: canvas at scale 1/2^k (levels[0] is the canvas store itself)
+        self.levels = [store] + [CanvasBlockStore(tile_size, VIEW_LEVEL_BLOCKS, VIEW_LEVEL_CODEC)
+                                 for _ in range(max_level)]
+        
+        self._tiles = OrderedDict()  # (level, tx, ty) -> BGR tile
+        self._cond = threading.Condition()
+        self._wanted = []            # tiles missing from the last paint, loaded in order
+        self._loading = None         # tile being loaded by the loader thread
+        self._touched = set()        # tiles rewritten while it was loading
+        self._generation = 0         # bumped by reset (drops loads for the old canvas)
+        self._thread = None
+        self.on_loaded = None        # called from the loader thread after each tile
+        
+    def reset(self):
+        with self._cond:
+            self._tiles.clear()
+            self._wanted = []
+            self._generation += 1
+        for level in self.levels[1:]:
+            level.reset()
+            
+    def _load(self, level: int, tx: int, ty: int) -> np.ndarray:
+        ts = self.tile_size
+        return self.levels[level].read(tx * ts, ty * ts, ts, ts)
+        
+    def _insert(self, key, tile: np.ndarray):
+        self._tiles[key] = tile
+        self._tiles.move_to_end(key)
+        while len(self._tiles) > self.max_tiles:
+            self._tiles.popitem(last=False)
+            
+    def peek(self, level: int, tx: int, ty: int) -> Optional[np.ndarray]:
+        """Tile đã nạp (dùng chung - không được sửa) hoặc None; không đọc store"""
+        key = (level, tx, ty)
+        with self._cond:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+            return tile
+            
+    def get_tile(self, level: int, tx: int, ty: int) -> np.ndarray:
+        """Tile (tx, ty) ở level, nạp đồng bộ nếu chưa có"""
+        tile = self.peek(level, tx, ty)
+        if tile is None:
+            tile = self._load(level, tx, ty)
+            with self._cond:
+                self._insert((level, tx, ty), tile)
+        return tile
+        
+    def request(self, keys: list):
+        """Nạp nền các tile (level, tx, ty); thay thế yêu cầu trước đó"""
+        with self._cond:
+            self._wanted = [k for k in keys if k not in self._tiles]
+            if self._wanted and self._thread is None:
+                self._thread = threading.Thread(target=self._loader, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+            
+    def _loader(self):
+        while True:
+            with self._cond:
+                while not self._wanted:
+                    self._cond.wait()
+                key = self._wanted.pop(0)
+                generation = self._generation
+                self._loading = key
+                self._touched.clear()
+                
+            tile = self._load(*key)
+            
+            with self._cond:
+                self._loading = None
+                if generation != self._generation or key in self._touched:
+                    continue
+                self._insert(key, tile)
+            if self.on_loaded:
+                self.on_loaded()
+                
+    def memory_usage(self) -> int:
+        with self._cond:
+            tiles = len(self._tiles)
+        return (tiles * self.tile_size * self.tile_size * 3
+                + sum(level.get_stats()["ram_bytes"] for level in self.levels[1:]))
+        
+    def shrink(self, nbytes: int) -> int:
+        """Bỏ các tile hiển thị ít dùng nhất, rồi nén block nóng của các level"""
+        tile_bytes = self.tile_size * self.tile_size * 3
+        freed = 0
+        with self._cond:
+            while freed < nbytes and self._tiles:
+                self._tiles.popitem(last=False)
+                freed += tile_bytes
+        for level in self.levels[1:]:
+            if freed >= nbytes:
+                break
+            freed += level.evict_hot(nbytes - freed, keep=0)
+        return freed
+        
+    def update(self, x: int, y: int, img: np.ndarray):
+        """
+        Cập nhật các level sau khi ghi img tại (x, y) vào canvas.
+        Vùng level k được tính lại từ level k-1 (INTER_AREA, thu nhỏ 1/2),
+        nên kết quả giống hệt khi dựng lại cả pyramid.
+        """
+        h, w = img.shape[:2]
+        ts = self.tile_size
+        x1, y1, x2, y2 = x, y, x + w, y + h  # dirty region at the current level
+        touched = []
+        
+        for level in range(1, self.max_level + 1):
+            # Region at this level covering the dirty region below (floor / ceil)
+            x1, y1 = x1 >> 1, y1 >> 1
+            x2, y2 = (x2 + 1) >> 1, (y2 + 1) >> 1
+            src = self.levels[level - 1].read(2 * x1, 2 * y1, 2 * (x2 - x1), 2 * (y2 - y1))
+            self.levels[level].write(x1, y1, cv2.resize(src, (x2 - x1, y2 - y1),
+                                                        interpolation=cv2.INTER_AREA))
+            
+            for ty in range(y1 // ts, (y2 - 1) // ts + 1):
+                for tx in range(x1 // ts, (x2 - 1) // ts + 1):
+                    touched.append((level, tx, ty))
+        for ty in range(y // ts, (y + h - 1) // ts + 1):
+            for tx in range(x // ts, (x + w - 1) // ts + 1):
+                touched.append((0, tx, ty))
+                
+        # Refresh display tiles that are loaded; in-flight loads are discarded
+        with self._cond:
+            cached = [k for k in touched if k in self._tiles]
+            if self._loading is not None:
+                self._touched.update(touched)
+        for key in cached:
+            tile = self._load(*key)
+            with self._cond:
+                if key in self._tiles:
+                    self._tiles[key] = tile
+
+
+# ============================================================================
+# COVERAGE GRID - Lưới phủ độ phân giải thấp
+# ============================================================================
+
+COVERAGE_CELL = 32  # canvas pixels per grid cell side
+
+
+class CoverageGrid:
+    """
+    Lưới phủ thô của canvas: mỗi ô (COVERAGE_CELL x COVERAGE_CELL px) = 1 nếu
+    tâm ô nằm trong một tile đã đặt. Cập nhật O(số ô của tile) mỗi lần đặt tile,
+    truy vấn vùng trống không cần đọc pixel.
+    """
+    
+    def __init__(self, cell: int = COVERAGE_CELL):
+        self.cell = cell
+        self.grid = np.zeros((0, 0), dtype=np.uint8)
+        self.origin = (0, 0)  # cell coordinates of grid[0, 0]
+        self.covered_cells = 0
+        
+        self._gaps = None  # cached enclosed-gap mask
+        
+    def reset(self):
+        self.grid = np.zeros((0, 0), dtype=np.uint8)
+        self.origin = (0, 0)
+        self.covered_cells = 0
+        self._gaps = None
+        
+    def _ensure(self, c1: int, r1: int, c2: int, r2: int):
+        """
+        Mở rộng lưới để chứa các ô [c1, c2] x [r1, r2]. Chỉ mở rộng cạnh bị
+        tràn, thêm tối thiểu nửa kích thước hiện tại để số lần copy ít (amortized).
+        """
+        ox, oy = self.origin
+        gh, gw = self.grid.shape
+        pad = 64  # minimum growth (cells) of an overflowing side
+        if not gw:
+            nx, ny = c1 - pad, r1 - pad
+            self.grid = np.zeros((r2 - r1 + 1 + 2 * pad, c2 - c1 + 1 + 2 * pad), dtype=np.uint8)
+            self.origin = (nx, ny)
+            return
+            
+        # Overflow per side (0 = side already fits)
+        left, top = max(0, ox - c1), max(0, oy - r1)
+        right, bottom = max(0, c2 - (ox + gw - 1)), max(0, r2 - (oy + gh - 1))
+        if not (left or top or right or bottom):
+            return
+            
+        grow_x, grow_y = max(pad, gw // 2), max(pad, gh // 2)
+        left = left + grow_x if left else 0
+        right = right + grow_x if right else 0
+        top = top + grow_y if top else 0
+        bottom = bottom + grow_y if bottom else 0
+        
+        new = np.zeros((gh + top + bottom, gw + left + right), dtype=np.uint8)
+        new[top:top+gh, left:left+gw] = self.grid
+        self.grid = new
+        self.origin = (ox - left, oy - top)
+        
+    def _center_cells(self, x: int, y: int, w: int, h: int) -> Tuple[int, int, int, int]:
+        """Các ô có tâm nằm trong vùng (x, y, w, h): (c1, r1, c2, r2) inclusive"""
+        half = self.cell // 2
+        return ((x - half + self.cell - 1) // self.cell, (y - half + self.cell - 1) // self.cell,
+                (x + w - 1 - half) // self.cell, (y + h - 1 - half) // self.cell)
+                
+    def _slice(self, c1: int, r1: int, c2: int, r2: int) -> np.ndarray:
+        ox, oy = self.origin
+        gh, gw = self.grid.shape
+        return self.grid[max(0, r1 - oy):max(0, min(gh, r2 - oy + 1)),
+                         max(0, c1 - ox):max(0, min(gw, c2 - ox + 1))]
+        
+    def mark(self, x: int, y: int, w: int, h: int):
+        """Đánh dấu tile (x, y, w, h) đã phủ"""
+        c1, r1, c2, r2 = self._center_cells(x, y, w, h)
+        if c2 < c1 or r2 < r1:
+            return
+        self._ensure(c1, r1, c2, r2)
+        region = self._slice(c1, r1, c2, r2)
+        self.covered_cells += region.size - int(np.count_nonzero(region))
+        region[:] = 1
+        self._gaps = None
+        
+    def any_covered(self, x: int, y: int, w: int, h: int) -> bool:
+        """Vùng (x, y, w, h) có chạm ô đã phủ nào không"""
+        region = self._slice(x // self.cell, y // self.cell,
+                             (x + w - 1) // self.cell, (y + h - 1) // self.cell)
+        return region.size > 0 and bool(region.any())
+        
+    def uncovered_fraction(self, x: int, y: int, w: int, h: int) -> float:
+        """Tỉ lệ ô chưa phủ trong vùng (x, y, w, h)"""
+        c1, r1, c2, r2 = self._center_cells(x, y, w, h)
+        total = max(0, c2 - c1 + 1) * max(0, r2 - r1 + 1)
+        if total == 0:
+            return 0.0
+        return 1.0 - np.count_nonzero(self._slice(c1, r1, c2, r2)) / total
+        
+    def gaps(self) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """
+        Mask các ô chưa phủ bị bao quanh bởi vùng đã phủ (lỗ cần quét lại),
+        cùng origin (ô) của mask. Tính lại chỉ khi lưới thay đổi.
+        """
+        if self._gaps is None:
+            if self.grid.size == 0:
+                self._gaps = np.zeros((0, 0), dtype=np.uint8)
+            else:
+                # Uncovered cells reachable from the border are outside, not gaps
+                padded = np.pad(self.grid, 1)
+                cv2.floodFill(padded, None, (0, 0), 2)
+                self._gaps = (padded[1:-1, 1:-1] == 0).astype(np.uint8)
+        return self._gaps, self.origin
+
+
 # ============================================================================
 # STITCHING CANVAS - Ghép ảnh với Image Registration
 # ============================================================================
@@ -131,16 +709,14 @@ class StitchingCanvas:
     """
     Canvas với image registration để ghép ảnh chính xác.
     Mỗi tile mới được match với canvas để tìm vị trí chính xác.
+    Pixel được lưu trong CanvasBlockStore (block nén + LRU cache).
     """
     
     def __init__(self):
-        # Main canvas
-        self.canvas = None
-        self.canvas_gray = None  # Grayscale version for matching
-        
-        # Canvas offset for negative coordinates
-        self.offset_x = 0
-        self.offset_y = 0
+        # Main canvas (block storage, world coordinates)
+        self.store = CanvasBlockStore()
+        self.view_cache = CanvasTileCache(self.store)
+        self.coverage = CoverageGrid()
         
         # Current position estimate
         self.current_x = 0.0
@@ -163,10 +739,9 @@ class StitchingCanvas:
         self.overlap_margin = 100  # Pixels to search for overlap
         
     def reset(self):
-        self.canvas = None
-        self.canvas_gray = None
-        self.offset_x = 0
-        self.offset_y = 0
+        self.store.reset()
+        self.view_cache.reset()
+        self.coverage.reset()
         self.current_x = 0.0
         self.current_y = 0.0
         self.last_tile_gray = None
@@ -175,71 +750,36 @@ class StitchingCanvas:
         self.min_y = self.max_y = 0
         self.tile_count = 0
         
-    def _ensure_size(self, x: int, y: int, w: int, h: int):
-        """Ensure canvas is large enough"""
-        if self.canvas is None:
-            # Initial size must be large enough for 5MP frames (2560x1920)
-            # Plus room for expansion in all directions
-            size = 8000
-            self.canvas = np.zeros((size, size, 3), dtype=np.uint8)
-            self.canvas_gray = np.zeros((size, size), dtype=np.uint8)
-            self.offset_x = size // 2
-            self.offset_y = size // 2
-            return
-            
-        cx = x + self.offset_x
-        cy = y + self.offset_y
-        ch, cw = self.canvas.shape[:2]
-        
-        margin = 500
-        if cx < margin or cy < margin or cx + w > cw - margin or cy + h > ch - margin:
-            new_size = max(cw, ch) + 2000
-            new_canvas = np.zeros((new_size, new_size, 3), dtype=np.uint8)
-            new_gray = np.zeros((new_size, new_size), dtype=np.uint8)
-            
-            ox = (new_size - cw) // 2
-            oy = (new_size - ch) // 2
-            
-            new_canvas[oy:oy+ch, ox:ox+cw] = self.canvas
-            new_gray[oy:oy+ch, ox:ox+cw] = self.canvas_gray
-            
-            self.canvas = new_canvas
-            self.canvas_gray = new_gray
-            self.offset_x += ox
-            self.offset_y += oy
-            
-    def _find_best_position(self, tile: np.ndarray, rough_x: int, rough_y: int) -> Tuple[int, int]:
+    def _find_best_position(self, tile_gray: np.ndarray, rough_x: int, rough_y: int) -> Tuple[int, int]:
         """
         Tìm vị trí chính xác bằng template matching với canvas.
         """
-        if self.canvas is None or self.tile_count == 0:
+        if self.tile_count == 0:
             return rough_x, rough_y
             
-        tile_h, tile_w = tile.shape[:2]
-        
-        # Convert tile to grayscale
-        if len(tile.shape) == 3:
-            tile_gray = cv2.cvtColor(tile, cv2.COLOR_BGR2GRAY)
-        else:
-            tile_gray = tile
+        tile_h, tile_w = tile_gray.shape[:2]
             
         # Define search region on canvas (around rough position)
         search_margin = 150  # Search +/- 150 pixels from rough estimate
         
-        cx = rough_x + self.offset_x
-        cy = rough_y + self.offset_y
-        
-        # Search region bounds
-        search_x1 = max(0, cx - search_margin)
-        search_y1 = max(0, cy - search_margin)
-        search_x2 = min(self.canvas.shape[1], cx + tile_w + search_margin)
-        search_y2 = min(self.canvas.shape[0], cy + tile_h + search_margin)
+        # Search region bounds (clipped to painted area)
+        search_x1 = max(self.min_x, rough_x - search_margin)
+        search_y1 = max(self.min_y, rough_y - search_margin)
+        search_x2 = min(self.max_x, rough_x + tile_w + search_margin)
+        search_y2 = min(self.max_y, rough_y + tile_h + search_margin)
         
-        search_region = self.canvas_gray[search_y1:search_y2, search_x1:search_x2]
-        
-        if search_region.shape[0] < tile_h or search_region.shape[1] < tile_w:
+        if search_y2 - search_y1 < tile_h or search_x2 - search_x1 < tile_w:
+            return rough_x, rough_y
+            
+        # Skip empty regions without reading pixels
+        if not self.coverage.any_covered(search_x1, search_y1,
+                                         search_x2 - search_x1, search_y2 - search_y1):
             return rough_x, rough_y
             
+        search_region = cv2.cvtColor(
+            self.store.read(search_x1, search_y1, search_x2 - search_x1, search_y2 - search_y1),
+            cv2.COLOR_BGR2GRAY)
+            
         # Check if search region has content (not empty)
         if np.max(search_region) < 10:
             return rough_x, rough_y
@@ -260,11 +800,11 @@ class StitchingCanvas:
             if max_val > 0.3:
                 # Calculate offset from template margin
                 if margin > 0 and template.shape == tile_gray[margin:-margin, margin:-margin].shape:
-                    best_x = search_x1 + max_loc[0] - margin - self.offset_x
-                    best_y = search_y1 + max_loc[1] - margin - self.offset_y
+                    best_x = search_x1 + max_loc[0] - margin
+                    best_y = search_y1 + max_loc[1] - margin
                 else:
-                    best_x = search_x1 + max_loc[0] - self.offset_x
-                    best_y = search_y1 + max_loc[1] - self.offset_y
+                    best_x = search_x1 + max_loc[0]
+                    best_y = search_y1 + max_loc[1]
                     
                 # Sanity check - don't allow huge jumps from rough estimate
                 if abs(best_x - rough_x) < search_margin and abs(best_y - rough_y) < search_margin:
@@ -281,18 +821,15 @@ class StitchingCanvas:
         dx, dy: displacement from last position (from tracker)
         """
         tile_h, tile_w = tile.shape[:2]
+        tile_gray = cv2.cvtColor(tile, cv2.COLOR_BGR2GRAY) if len(tile.shape) == 3 else tile
+        if len(tile.shape) == 2:
+            tile = cv2.cvtColor(tile, cv2.COLOR_GRAY2BGR)
         
         # First tile - place at origin
         if self.tile_count == 0:
-            self._ensure_size(0, 0, tile_w, tile_h)
-            
-            cx = self.offset_x
-            cy = self.offset_y
-            
-            self.canvas[cy:cy+tile_h, cx:cx+tile_w] = tile
-            
-            tile_gray = cv2.cvtColor(tile, cv2.COLOR_BGR2GRAY) if len(tile.shape) == 3 else tile
-            self.canvas_gray[cy:cy+tile_h, cx:cx+tile_w] = tile_gray
+            self.store.write(0, 0, tile)
+            self.view_cache.update(0, 0, tile)
+            self.coverage.mark(0, 0, tile_w, tile_h)
             
             self.last_tile_gray = tile_gray.copy()
             self.last_tile_pos = (0, 0)
@@ -314,30 +851,16 @@ class StitchingCanvas:
         rough_y = int(self.current_y + dy)
         
         # Find precise position using image registration
-        precise_x, precise_y = self._find_best_position(tile, rough_x, rough_y)
+        precise_x, precise_y = self._find_best_position(tile_gray, rough_x, rough_y)
         
         # Update current position
         self.current_x = precise_x
         self.current_y = precise_y
-        
-        # Ensure canvas size
-        self._ensure_size(precise_x, precise_y, tile_w, tile_h)
-        
-        # Place tile
-        cx = precise_x + self.offset_x
-        cy = precise_y + self.offset_y
-        
-        # Bounds check
-        if cx < 0 or cy < 0:
-            return False
-        if cx + tile_w > self.canvas.shape[1] or cy + tile_h > self.canvas.shape[0]:
-            return False
             
         # Simple placement (overwrite)
-        self.canvas[cy:cy+tile_h, cx:cx+tile_w] = tile
-        
-        tile_gray = cv2.cvtColor(tile, cv2.COLOR_BGR2GRAY) if len(tile.shape) == 3 else tile
-        self.canvas_gray[cy:cy+tile_h, cx:cx+tile_w] = tile_gray
+        self.store.write(precise_x, precise_y, tile)
+        self.view_cache.update(precise_x, precise_y, tile)
+        self.coverage.mark(precise_x, precise_y, tile_w, tile_h)
         
         # Update state
         self.last_tile_gray = tile_gray.copy()
@@ -357,18 +880,303 @@ class StitchingCanvas:
         return self.current_x, self.current_y
         
     def get_canvas(self) -> Optional[np.ndarray]:
-        if self.canvas is None or self.tile_count == 0:
+        if self.tile_count == 0:
+            return None
+            
+        w = self.max_x - self.min_x
+        h = self.max_y - self.min_y
+        if w <= 0 or h <= 0:
             return None
             
-        x1 = max(0, self.min_x + self.offset_x)
-        y1 = max(0, self.min_y + self.offset_y)
-        x2 = min(self.canvas.shape[1], self.max_x + self.offset_x)
-        y2 = min(self.canvas.shape[0], self.max_y + self.offset_y)
+        return self.store.read(self.min_x, self.min_y, w, h)
+    
+    def uncovered_fraction(self, dx: float, dy: float, w: int, h: int) -> float:
+        """Tỉ lệ chưa phủ của tile kế tiếp dự đoán tại vị trí hiện tại + (dx, dy)"""
+        if self.tile_count == 0:
+            return 1.0
+        return self.coverage.uncovered_fraction(
+            int(self.current_x + dx), int(self.current_y + dy), w, h)
+        
+    def get_memory_stats(self) -> dict:
+        """Thống kê bộ nhớ canvas"""
+        return self.store.get_stats()
+
+
+# ============================================================================
+# TILE ARCHIVE - Lưu tile gốc lên đĩa, render lại theo yêu cầu
+# ============================================================================
+
+class TileArchive:
+    """
+    Archive tile gốc (chưa hiệu chỉnh) trên đĩa.
+    Mỗi tile là một file PNG nén (chunk), vị trí và tham số hiệu chỉnh
+    được ghi vào index.jsonl. Việc ghi chạy trên background thread.
+    """
+    
+    INDEX_FILE = "index.jsonl"
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.tile_count = 0
+        self.pending = 0
+        self.pending_bytes = 0  # raw frames waiting in the write queue
+        self.failed = 0
+        
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()  # pending counters change on both threads
+        
+    def open(self):
+        """Mở archive để ghi (tạo thư mục, khởi động writer thread)"""
+        os.makedirs(self.path, exist_ok=True)
+        self.tile_count = len(self.read_index())
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+        
+    def close(self):
+        """Chờ ghi xong các tile còn lại và dừng writer thread"""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._queue = None
+        
+    def append(self, frame: np.ndarray, x: int, y: int, corrections: dict):
+        """
+        Thêm tile vào hàng đợi ghi.
+        frame: ảnh gốc từ camera (không được sửa sau khi gọi)
+        """
+        if self._queue is None:
+            return
+        entry = {
+            "id": self.tile_count,
+            "file": f"tile_{self.tile_count:06d}.png",
+            "x": int(x),
+            "y": int(y),
+            "w": int(frame.shape[1]),
+            "h": int(frame.shape[0]),
+            "corrections": corrections,
+            "time": time.time(),
+        }
+        self.tile_count += 1
+        with self._lock:
+            self.pending += 1
+            self.pending_bytes += frame.nbytes
+        self._queue.put((frame, entry))
+        
+    def _writer(self):
+        index_path = os.path.join(self.path, self.INDEX_FILE)
+        with open(index_path, "a", encoding="utf-8") as index:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                frame, entry = item
+                try:
+                    ok = cv2.imwrite(os.path.join(self.path, entry["file"]), frame,
+                                     [cv2.IMWRITE_PNG_COMPRESSION, 1])
+                    if not ok:
+                        raise IOError(entry["file"])
+                    index.write(json.dumps(entry) + "\n")
+                    index.flush()
+                except Exception:
+                    self.failed += 1
+                with self._lock:
+                    self.pending -= 1
+                    self.pending_bytes -= frame.nbytes
+                
+    def read_index(self) -> list:
+        """Đọc danh sách tile (theo thứ tự ghi)"""
+        index_path = os.path.join(self.path, self.INDEX_FILE)
+        if not os.path.exists(index_path):
+            return []
+        entries = []
+        with open(index_path, encoding="utf-8") as index:
+            for line in index:
+                line = line.strip()
+                if line:
+                    entries.append(json.loads(line))
+        return entries
+        
+    def get_bounds(self, entries: Optional[list] = None) -> Optional[Tuple[int, int, int, int]]:
+        """Bounds (min_x, min_y, max_x, max_y) của toàn bộ tile"""
+        entries = self.read_index() if entries is None else entries
+        if not entries:
+            return None
+        return (min(e["x"] for e in entries), min(e["y"] for e in entries),
+                max(e["x"] + e["w"] for e in entries), max(e["y"] + e["h"] for e in entries))
         
-        if x2 <= x1 or y2 <= y1:
+    def render(self, x: Optional[int] = None, y: Optional[int] = None,
+               w: Optional[int] = None, h: Optional[int] = None,
+               scale: float = 1.0, corrections: Optional[dict] = None) -> Optional[np.ndarray]:
+        """
+        Ghép lại vùng (x, y, w, h) ở tỉ lệ scale từ tile gốc.
+        corrections: tham số hiệu chỉnh mới; None = dùng tham số lúc quét.
+        Mặc định render toàn bộ slide.
+        """
+        entries = self.read_index()
+        bounds = self.get_bounds(entries)
+        if bounds is None:
             return None
+        if x is None:
+            x, y = bounds[0], bounds[1]
+            w, h = bounds[2] - bounds[0], bounds[3] - bounds[1]
+            
+        out_w, out_h = max(1, int(w * scale)), max(1, int(h * scale))
+        out = np.zeros((out_h, out_w, 3), dtype=np.uint8)
+        corrector = ImageCorrector()
+        
+        # Reduced decode for small zoom levels
+        if scale <= 0.125:
+            flag = cv2.IMREAD_REDUCED_COLOR_8
+        elif scale <= 0.25:
+            flag = cv2.IMREAD_REDUCED_COLOR_4
+        elif scale <= 0.5:
+            flag = cv2.IMREAD_REDUCED_COLOR_2
+        else:
+            flag = cv2.IMREAD_COLOR
+            
+        # Composite in capture order (later tiles overwrite, like the canvas)
+        for e in entries:
+            if e["x"] >= x + w or e["y"] >= y + h or e["x"] + e["w"] <= x or e["y"] + e["h"] <= y:
+                continue
+            tile = cv2.imread(os.path.join(self.path, e["file"]), flag)
+            if tile is None:
+                continue
+                
+            corrector.set_params(e["corrections"] if corrections is None else corrections)
+            tile = corrector.correct(tile)
             
-        return self.canvas[y1:y2, x1:x2].copy()
+            tw, th = max(1, int(e["w"] * scale)), max(1, int(e["h"] * scale))
+            if tile.shape[1] != tw or tile.shape[0] != th:
+                tile = cv2.resize(tile, (tw, th), interpolation=cv2.INTER_AREA)
+                
+            ox = int(round((e["x"] - x) * scale))
+            oy = int(round((e["y"] - y) * scale))
+            x1, y1 = max(0, ox), max(0, oy)
+            x2, y2 = min(out_w, ox + tw), min(out_h, oy + th)
+            if x2 > x1 and y2 > y1:
+                out[y1:y2, x1:x2] = tile[y1-oy:y2-oy, x1-ox:x2-ox]
+                
+        return out
+
+
+# ============================================================================
+# MEMORY GOVERNOR - Ngân sách RAM chung cho canvas, cache và hàng đợi
+# ============================================================================
+
+MEMORY_BUDGET_MB = 2048  # default RAM budget
+
+
+class MemoryGovernor:
+    """
+    Kế toán RAM trung tâm. Mỗi buffer lớn đăng ký một hàm đo (bytes).
+    Khi tổng vượt HIGH_WATER * budget, các policy được áp dụng theo thứ tự
+    đăng ký cho tới khi về dưới LOW_WATER * budget.
+    """
+    
+    HIGH_WATER = 0.9
+    LOW_WATER = 0.75
+    
+    def __init__(self, budget_bytes: int):
+        self.budget = budget_bytes
+        self._components = OrderedDict()  # name -> usage() -> bytes
+        self._policies = []               # (name, apply(nbytes) -> freed bytes)
+        self.pressure = False             # still over budget after all policies
+        self.last_actions = []
+        
+    def register(self, name: str, usage):
+        self._components[name] = usage
+        
+    def unregister(self, name: str):
+        self._components.pop(name, None)
+        
+    def add_policy(self, name: str, apply):
+        self._policies.append((name, apply))
+        
+    def usage(self) -> dict:
+        return {name: int(fn()) for name, fn in self._components.items()}
+        
+    def total(self) -> int:
+        return sum(self.usage().values())
+        
+    def enforce(self) -> list:
+        """Áp dụng policy nếu cần. Trả về tên các policy đã dùng."""
+        actions = []
+        total = self.total()
+        if total > self.budget * self.HIGH_WATER:
+            target = self.budget * self.LOW_WATER
+            for name, apply in self._policies:
+                if total <= target:
+                    break
+                if apply(int(total - target)) > 0:
+                    actions.append(name)
+                total = self.total()
+        self.pressure = total > self.budget
+        self.last_actions = actions
+        return actions
+
+
+# ============================================================================
+# FRAME PYRAMID - Ảnh nhiều mức dùng chung cho mỗi frame
+# ============================================================================
+
+class FramePyramid:
+    """
+    Pyramid cho một frame, dựng lười (lazy) và ghi nhớ kết quả.
+    Chỉ mức đầu tiên (pyrDown) đọc ảnh độ phân giải đầy đủ; tracker, live view,
+    focus score... đều lấy ảnh nhỏ từ mức gần nhất.
+    Ảnh trả về là dùng chung - không được sửa trực tiếp.
+    """
+    
+    def __init__(self, frame: np.ndarray):
+        self.frame = frame
+        self._levels = [frame]
+        self._resized = {}  # (w, h, gray) -> image
+        
+    @property
+    def width(self) -> int:
+        return self.frame.shape[1]
+        
+    @property
+    def height(self) -> int:
+        return self.frame.shape[0]
+        
+    def level(self, n: int) -> np.ndarray:
+        """Mức n của pyramid (mỗi mức giảm 1/2)"""
+        while len(self._levels) <= n:
+            self._levels.append(cv2.pyrDown(self._levels[-1]))
+        return self._levels[n]
+        
+    def resized(self, w: int, h: int, gray: bool = False) -> np.ndarray:
+        """Ảnh kích thước (w, h), resize INTER_AREA từ mức nhỏ nhất còn >= (w, h)"""
+        key = (w, h, gray)
+        img = self._resized.get(key)
+        if img is not None:
+            return img
+            
+        if gray:
+            color = self.resized(w, h)
+            img = cv2.cvtColor(color, cv2.COLOR_BGR2GRAY) if color.ndim == 3 else color
+        else:
+            n = 0
+            while (self.width >> (n + 1)) >= w and (self.height >> (n + 1)) >= h:
+                n += 1
+            src = self.level(n)
+            if src.shape[1] == w and src.shape[0] == h:
+                img = src
+            else:
+                img = cv2.resize(src, (w, h), interpolation=cv2.INTER_AREA)
+                
+        self._resized[key] = img
+        return img
+        
+    def focus_score(self) -> float:
+        """Độ nét (variance of Laplacian) trên ảnh xám 320x240"""
+        gray = self.resized(320, 240, gray=True)
+        return float(cv2.Laplacian(gray, cv2.CV_32F).var())
 
 
 # ============================================================================
@@ -380,16 +1188,30 @@ class SimpleTracker:
     
     def __init__(self):
         self.prev_gray = None
+        self.prev_time = None
+        self.velocity = (0.0, 0.0)  # px/s (full resolution), from capture timestamps
+        self.last_shift = (0.0, 0.0)  # unfiltered shift of the last frame (full resolution)
         
     def reset(self):
         self.prev_gray = None
+        self.prev_time = None
+        self.velocity = (0.0, 0.0)
+        self.last_shift = (0.0, 0.0)
         
-    def get_displacement(self, frame: np.ndarray) -> Tuple[float, float]:
-        """Tính displacement từ frame trước"""
+    def get_displacement(self, frame, full_size: Optional[Tuple[int, int]] = None,
+                         timestamp: Optional[float] = None) -> Tuple[float, float]:
+        """
+        Tính displacement từ frame trước.
+        frame: FramePyramid (dùng chung) hoặc np.ndarray.
+        full_size: (w, h) độ phân giải đầy đủ nếu frame đã được giải mã thu nhỏ;
+        displacement luôn trả về theo pixel của độ phân giải đầy đủ.
+        timestamp: thời điểm chụp (time.monotonic) để tính vận tốc.
+        """
+        pyramid = frame if isinstance(frame, FramePyramid) else FramePyramid(frame)
+        full_w, full_h = full_size if full_size else (pyramid.width, pyramid.height)
         
-        # Downscale for speed
-        small = cv2.resize(frame, (320, 240))
-        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if len(small.shape) == 3 else small
+        # Downscale for speed (shared pyramid level)
+        gray = pyramid.resized(320, 240, gray=True)
         
         dx, dy = 0.0, 0.0
         
@@ -402,11 +1224,12 @@ class SimpleTracker:
                 )
                 
                 # Scale back to original size
-                scale_x = frame.shape[1] / 320
-                scale_y = frame.shape[0] / 240
+                scale_x = full_w / 320
+                scale_y = full_h / 240
                 
                 dx = -shift[0] * scale_x
                 dy = -shift[1] * scale_y
+                self.last_shift = (dx, dy)
                 
                 # Filter noise
                 if abs(dx) < 5:
@@ -417,10 +1240,80 @@ class SimpleTracker:
             except:
                 pass
                 
-        self.prev_gray = gray.copy()
+            # Velocity from real capture timing
+            if timestamp is not None and self.prev_time is not None and timestamp > self.prev_time:
+                dt = timestamp - self.prev_time
+                self.velocity = (dx / dt, dy / dt)
+                
+        self.prev_gray = gray
+        self.prev_time = timestamp
         return dx, dy
 
 
+# ============================================================================
+# TEMPORAL AVERAGER - Trung bình nhiều frame khi bàn kính đứng yên
+# ============================================================================
+
+STATIONARY_PX = 2.0  # max drift (full-res px) while still counted as stationary
+STILL_FRAMES = 4     # frames whose total drift <= STATIONARY_PX / 2 before averaging starts
+
+
+class TemporalAverager:
+    """
+    Cộng dồn các frame khi bàn kính đứng yên vào một buffer uint16 cấp phát
+    sẵn (cộng tại chỗ, không cấp phát mỗi frame). Ảnh trung bình giảm nhiễu
+    ~sqrt(N) lần và được dùng làm tile thay cho một frame đơn.
+    """
+    
+    def __init__(self, max_frames: int = 8):
+        self.max_frames = max_frames  # <= 256 so the uint16 sum cannot overflow
+        self.count = 0
+        self.drift = (0.0, 0.0)  # accumulated tracker shift since the first frame
+        
+        self._acc = None
+        
+    def reset(self):
+        """Bắt đầu lượt mới (giữ lại buffer)"""
+        self.count = 0
+        self.drift = (0.0, 0.0)
+        
+    def release(self):
+        self.reset()
+        self._acc = None
+        
+    def memory_usage(self) -> int:
+        return self._acc.nbytes if self._acc is not None else 0
+        
+    def add(self, frame: np.ndarray, shift: Tuple[float, float] = (0.0, 0.0)) -> bool:
+        """
+        Cộng frame vào buffer. shift: dịch chuyển thô của frame này (tracker).
+        Trả về False nếu frame không dùng được (khác kích thước hoặc đã trôi quá
+        STATIONARY_PX) - khi đó gọi result() / reset().
+        """
+        if self.count > 0:
+            drift = (self.drift[0] + shift[0], self.drift[1] + shift[1])
+            if np.hypot(*drift) > STATIONARY_PX or self._acc.shape != frame.shape:
+                return False
+            self.drift = drift
+            cv2.add(self._acc, frame, dst=self._acc, dtype=cv2.CV_16U)
+        else:
+            if self._acc is None or self._acc.shape != frame.shape:
+                self._acc = np.empty(frame.shape, dtype=np.uint16)
+            self._acc[...] = frame
+            self.drift = (0.0, 0.0)
+        self.count += 1
+        return True
+        
+    def is_full(self) -> bool:
+        return self.count >= self.max_frames
+        
+    def result(self) -> Optional[np.ndarray]:
+        """Ảnh trung bình uint8 (ảnh mới, an toàn để lưu/archive)"""
+        if self.count == 0:
+            return None
+        return cv2.convertScaleAbs(self._acc, alpha=1.0 / self.count)
+
+
 # ============================================================================
 # CAMERA SETTINGS - Euromex CMEX-5f DC.5000f
 # ============================================================================
@@ -443,25 +1336,273 @@ CAMERA_SPECS = {
 }
 
 
+# ============================================================================
+# CAMERA DISCOVERY - Dò camera song song, cache khả năng thiết bị
+# ============================================================================
+
+# Capture backends tried in order: name -> OpenCV API preference
+CAMERA_BACKENDS = {
+    "DSHOW": cv2.CAP_DSHOW,
+    "ANY": cv2.CAP_ANY,
+}
+
+
+class CameraDiscovery:
+    """
+    Dò các camera song song (mỗi thiết bị một thread, có timeout) và ghi lại
+    backend mở được, các preset độ phân giải thực sự hỗ trợ và FPS đo được.
+    Kết quả được cache trên đĩa để lần chạy sau điền UI ngay lập tức.
+    """
+    
+    CACHE_PATH = os.path.join(os.path.expanduser("~"), ".pathocam_cameras.json")
+    CACHE_VERSION = 2  # 2: presets measured per capture mode
+    
+    @staticmethod
+    def _probe_device(index: int, partial: Optional[dict] = None,
+                      cancel: Optional[threading.Event] = None) -> Optional[dict]:
+        """
+        Mở thiết bị index và thử từng preset trong CAMERA_RESOLUTIONS với từng
+        định dạng trong CAPTURE_MODES (MJPEG thường có preset mà YUY2 không có).
+        Kết quả từng phần được ghi dần vào partial; dừng sớm (và đóng thiết bị)
+        khi cancel được set.
+        """
+        if partial is None:
+            partial = {}
+        cap = None
+        backend = None
+        for name, api in CAMERA_BACKENDS.items():
+            cap = cv2.VideoCapture(index, api)
+            if cap.isOpened():
+                backend = name
+                break
+            cap.release()
+        if backend is None:
+            return None
+        partial["backend"] = backend
+            
+        presets = {}  # preset -> {capture mode -> fps info}
+        try:
+            for mode, fourcc in CAPTURE_MODES.items():
+                if cancel is not None and cancel.is_set():
+                    break
+                # Fresh capture per mode so "driver default" really is the default
+                if cap is None:
+                    cap = cv2.VideoCapture(index, CAMERA_BACKENDS[backend])
+                    if not cap.isOpened():
+                        continue
+                code = cv2.VideoWriter_fourcc(*fourcc) if fourcc else 0
+                
+                for preset, (width, height, fps) in CAMERA_RESOLUTIONS.items():
+                    if cancel is not None and cancel.is_set():
+                        break
+                    # Pixel format must be negotiated before the frame size
+                    if fourcc:
+                        cap.set(cv2.CAP_PROP_FOURCC, code)
+                    cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+                    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+                    cap.set(cv2.CAP_PROP_FPS, fps)
+                    actual = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                              int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+                    # Some backends report 0 for FOURCC; only a different code is a refusal
+                    got = int(cap.get(cv2.CAP_PROP_FOURCC))
+                    if fourcc and got and got != code:
+                        continue
+                    if actual != (width, height) or not cap.grab():
+                        continue
+                        
+                    # Short FPS measurement over a few frames
+                    t0 = time.monotonic()
+                    grabbed = sum(1 for _ in range(3) if cap.grab())
+                    elapsed = time.monotonic() - t0
+                    measured = grabbed / elapsed if grabbed and elapsed > 0 else 0.0
+                    
+                    presets.setdefault(preset, {})[mode] = {
+                        "reported_fps": float(cap.get(cv2.CAP_PROP_FPS) or 0.0),
+                        "measured_fps": round(measured, 1),
+                    }
+                    # Publish a copy: the reader never sees a dict being filled
+                    partial["presets"] = {name: dict(modes) for name, modes in presets.items()}
+                cap.release()
+                cap = None
+        finally:
+            if cap is not None:
+                cap.release()
+            
+        return {"backend": backend, "presets": presets}
+        
+    @classmethod
+    def probe(cls, indices=range(5), timeout: float = 20.0) -> dict:
+        """
+        Dò các thiết bị song song. Thiết bị chưa dò xong trong timeout được trả về
+        với "unverified": True và kết quả từng phần (backend có thể là None);
+        thread dò của nó được báo dừng và đóng thiết bị ở bước kế tiếp.
+        Trả về {index: {"backend": ..., "presets": {preset: {mode: {...}}}}}.
+        """
+        results = {}
+        partial = {index: {"backend": None, "presets": {}} for index in indices}
+        cancel = threading.Event()
+        
+        def worker(index):
+            try:
+                info = cls._probe_device(index, partial[index], cancel)
+            except Exception:
+                info = None
+            if info is not None:
+                results[index] = info
+                
+        threads = {i: threading.Thread(target=worker, args=(i,), daemon=True) for i in indices}
+        for t in threads.values():
+            t.start()
+        deadline = time.monotonic() + timeout
+        for t in threads.values():
+            t.join(max(0.0, deadline - time.monotonic()))
+        cancel.set()
+        
+        for index, t in threads.items():
+            if t.is_alive():
+                results[index] = dict(partial[index], unverified=True)
+        return dict(sorted(results.items()))
+        
+    @classmethod
+    def load(cls) -> dict:
+        """Đọc cache (rỗng nếu chưa có hoặc lỗi)"""
+        try:
+            with open(cls.CACHE_PATH, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != cls.CACHE_VERSION:
+                return {}
+            return {int(k): v for k, v in data.get("devices", {}).items()}
+        except (OSError, ValueError):
+            return {}
+            
+    @classmethod
+    def save(cls, devices: dict):
+        try:
+            with open(cls.CACHE_PATH, "w", encoding="utf-8") as f:
+                json.dump({"version": cls.CACHE_VERSION, "time": time.time(),
+                           "devices": {str(k): v for k, v in devices.items()}}, f, indent=2)
+        except OSError:
+            pass
+
+
+class CameraProbeThread(QThread):
+    """Chạy CameraDiscovery.probe ngoài GUI thread"""
+    devices_ready = pyqtSignal(dict)
+    
+    def run(self):
+        devices = CameraDiscovery.probe()
+        CameraDiscovery.save(devices)
+        self.devices_ready.emit(devices)
+
+
+# Capture modes: name -> FOURCC requested from the driver
+CAPTURE_MODES = {
+    "MJPEG (nén, nhanh)": "MJPG",   # Compressed over USB 2.0, decoded in pool
+    "YUY2 (không nén)": "YUY2",     # Uncompressed, few fps at 5MP
+    "Mặc định driver": None,
+}
+
+# Minimum width of reduced (DCT-scaled) frames for tracking / preview
+REDUCED_MIN_WIDTH = 640
+
+
 # ============================================================================
 # CAMERA THREAD
 # ============================================================================
 
 class CameraThread(QThread):
-    frame_ready = pyqtSignal(np.ndarray)
+    # frame, capture timestamp (time.monotonic, seconds), sequence number
+    frame_ready = pyqtSignal(np.ndarray, float, int)
     error = pyqtSignal(str)
     
-    def __init__(self, index: int = 0, resolution: str = "5MP (2560x1920)"):
+    # Measured decoded FPS: (resolution, capture mode) -> fps
+    measured_fps = {}
+    
+    # A grab() returning faster than this fraction of the frame period, for a
+    # frame arriving well before the next one is due, means the frame was
+    # already sitting in the driver buffer (stale)
+    STALE_GRAB_FRACTION = 0.25
+    MAX_DRAIN = 4           # max consecutive stale frames dropped
+    MAX_BACKLOG = 2         # emitted frames the consumer may lag behind
+    
+    def __init__(self, index: int = 0, resolution: str = "5MP (2560x1920)",
+                 capture_mode: str = "MJPEG (nén, nhanh)", reduced_decode: bool = True,
+                 decode_workers: int = 3, backend: Optional[str] = None):
         super().__init__()
         self.index = index
+        self.backend = backend  # Known-good backend from discovery (skips fallback)
         self.resolution = resolution
+        self.capture_mode = capture_mode
+        self.reduced_decode = reduced_decode
+        self.decode_workers = decode_workers
         self.running = False
         self.actual_resolution = (0, 0)
-        
+        self.compressed = False  # True if driver delivers raw MJPEG buffers
+        self.decode_fps = 0.0
+        
+        # Sequence bookkeeping (every grabbed frame gets a number)
+        self.consumed_seq = -1   # set by the consumer after processing a frame (opt-in)
+        self.emitted_seq = -1
+        self.dropped = 0         # grabbed but never retrieved
+        self._emitted = deque(maxlen=64)  # seqs emitted, not yet known consumed
+        
+        self._full_requested = True
+        self.frame_stride = 1    # >1: retrieve only every Nth non-keyframe (memory pressure)
+        self._pending = deque()  # (future, timestamp, seq) in capture order
+        self._lock = threading.Lock()
+        self._frame_count = 0
+        
+    def request_full_frame(self):
+        """Yêu cầu frame tiếp theo được giải mã đầy đủ (dùng làm tile)"""
+        self._full_requested = True
+        
+    def backlog(self) -> int:
+        """Số frame đã emit nhưng consumer chưa xử lý (bỏ qua frame bị drop)"""
+        if self.consumed_seq < 0:
+            return 0
+        with self._lock:
+            while self._emitted and self._emitted[0] <= self.consumed_seq:
+                self._emitted.popleft()
+            return len(self._emitted)
+            
+    def memory_usage(self) -> int:
+        """Ước lượng RAM của frame đang giải mã / chờ consumer xử lý"""
+        w, h = self.actual_resolution
+        return (len(self._pending) + self.backlog()) * w * h * 3
+        
+    @staticmethod
+    def _reduced_flag(width: int) -> int:
+        """Cờ imdecode thu nhỏ (DCT scaling) lớn nhất vẫn giữ >= REDUCED_MIN_WIDTH"""
+        for factor, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                             (4, cv2.IMREAD_REDUCED_COLOR_4),
+                             (2, cv2.IMREAD_REDUCED_COLOR_2)):
+            if width // factor >= REDUCED_MIN_WIDTH:
+                return flag
+        return cv2.IMREAD_COLOR
+        
+    @staticmethod
+    def _decode(buf: np.ndarray, flag: int) -> Optional[np.ndarray]:
+        return cv2.imdecode(buf.reshape(-1), flag)
+        
+    def _flush(self, *_):
+        """Emit decoded frames in capture order (also called from pool threads)"""
+        with self._lock:
+            while self._pending and self._pending[0][0].done():
+                future, timestamp, seq = self._pending.popleft()
+                frame = future.result()
+                if frame is not None:
+                    self.emitted_seq = seq
+                    self._emitted.append(seq)
+                    self._frame_count += 1
+                    self.frame_ready.emit(frame, timestamp, seq)
+                    
     def run(self):
-        cap = cv2.VideoCapture(self.index, cv2.CAP_DSHOW)
-        if not cap.isOpened():
-            cap = cv2.VideoCapture(self.index)
+        if self.backend in CAMERA_BACKENDS:
+            cap = cv2.VideoCapture(self.index, CAMERA_BACKENDS[self.backend])
+        else:
+            cap = cv2.VideoCapture(self.index, cv2.CAP_DSHOW)
+            if not cap.isOpened():
+                cap = cv2.VideoCapture(self.index)
             
         if not cap.isOpened():
             self.error.emit("Không thể mở camera!")
@@ -471,6 +1612,11 @@ class CameraThread(QThread):
         res = CAMERA_RESOLUTIONS.get(self.resolution, (2560, 1920, 30))
         width, height, fps = res
         
+        # Pixel format must be negotiated before the frame size
+        fourcc = CAPTURE_MODES.get(self.capture_mode)
+        if fourcc:
+            cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+        
         # Apply camera settings for Euromex DC.5000f
         cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
         cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
@@ -481,23 +1627,90 @@ class CameraThread(QThread):
         cap.set(cv2.CAP_PROP_AUTOFOCUS, 0)  # Disable autofocus if available
         cap.set(cv2.CAP_PROP_AUTO_EXPOSURE, 1)  # Manual exposure mode
         
+        # Ask for undecoded MJPEG buffers so decoding runs in our pool
+        self.compressed = fourcc == "MJPG" and bool(cap.set(cv2.CAP_PROP_CONVERT_RGB, 0))
+        
         # Get actual resolution
         self.actual_resolution = (
             int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
             int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
         )
+        reduced_flag = self._reduced_flag(self.actual_resolution[0])
         
         self.running = True
         
-        # Adjust sleep based on target FPS
-        sleep_ms = max(20, int(1000 / fps) - 5)
+        # Stale detection uses the driver-reported FPS when available
+        actual_fps = cap.get(cv2.CAP_PROP_FPS) or fps
+        period = 1.0 / max(actual_fps, 1)
+        stale_time = self.STALE_GRAB_FRACTION * period
+        
+        # Decode pool with ordered delivery
+        pool = ThreadPoolExecutor(max_workers=self.decode_workers)
+        max_pending = self.decode_workers * 2
+        
+        seq = -1
+        drained = 0
+        last_grab = None  # time the previous frame was delivered by grab()
+        last_fps_time = time.monotonic()
         
         while self.running:
-            ret, frame = cap.read()
-            if ret:
-                self.frame_ready.emit(frame)
-            self.msleep(sleep_ms)
+            # grab() blocks until the driver has a frame; no fixed sleep
+            t0 = time.monotonic()
+            if not cap.grab():
+                self.msleep(5)
+                continue
+            timestamp = time.monotonic()
+            seq += 1
+            
+            # Drain frames that were already buffered by the driver: grab() did not
+            # wait AND the frame came well before the next one was due. A fresh frame
+            # that arrived while we were busy in retrieve() also returns at once,
+            # but about one period after the previous one.
+            early = last_grab is not None and timestamp - last_grab < period - stale_time
+            last_grab = timestamp
+            if timestamp - t0 < stale_time and early and drained < self.MAX_DRAIN:
+                drained += 1
+                self.dropped += 1
+                continue
+            drained = 0
             
+            # Only retrieve frames the consumer and decode pool can take
+            lagging = self.backlog() > self.MAX_BACKLOG
+            decimated = self.frame_stride > 1 and seq % self.frame_stride and not self._full_requested
+            if (lagging or decimated
+                    or len(self._pending) >= max_pending):
+                self.dropped += 1
+                continue
+                
+            ret, buf = cap.retrieve()
+            if ret:
+                # Any retrieved frame answers the full-frame request
+                full = self._full_requested
+                self._full_requested = False
+                if self.compressed and (buf.ndim == 1 or buf.shape[0] == 1):
+                    flag = cv2.IMREAD_COLOR
+                    if self.reduced_decode and not full:
+                        flag = reduced_flag
+                    future = pool.submit(self._decode, buf, flag)
+                else:
+                    # Driver already decoded (or ignored CONVERT_RGB)
+                    future = Future()
+                    future.set_result(buf)
+                with self._lock:
+                    self._pending.append((future, timestamp, seq))
+                future.add_done_callback(self._flush)
+            else:
+                self.dropped += 1
+                
+            now = time.monotonic()
+            if now - last_fps_time >= 1.0:
+                self.decode_fps = self._frame_count / (now - last_fps_time)
+                CameraThread.measured_fps[(self.resolution, self.capture_mode)] = self.decode_fps
+                self._frame_count = 0
+                last_fps_time = now
+                
+        pool.shutdown(wait=True)
+        self._flush()
         cap.release()
         
     def stop(self):
@@ -505,6 +1718,607 @@ class CameraThread(QThread):
         self.wait(2000)
 
 
+# ============================================================================
+# REPLAY SOURCE - Phát lại stream đã ghi thay cho camera
+# ============================================================================
+
+class ReplayThread(QThread):
+    """
+    Nguồn frame từ file video hoặc chuỗi ảnh (ví dụ "rec/frame_%06d.png"),
+    cùng giao diện với CameraThread. Dùng để chạy pipeline không cần kính hiển vi.
+    """
+    frame_ready = pyqtSignal(np.ndarray, float, int)
+    error = pyqtSignal(str)
+    
+    def __init__(self, path: str, fps: Optional[float] = None, realtime: bool = True):
+        super().__init__()
+        self.path = path
+        self.fps = fps            # None: FPS stored in the file (30 if unknown)
+        self.realtime = realtime  # False: emit frames as fast as they are consumed
+        self.running = False
+        self.actual_resolution = (0, 0)
+        self.compressed = False
+        self.decode_fps = 0.0
+        
+        # Same bookkeeping as CameraThread
+        self.consumed_seq = -1
+        self.emitted_seq = -1
+        self.dropped = 0
+        self.frame_stride = 1
+        self._emitted = deque(maxlen=64)
+        
+    def request_full_frame(self):
+        """Frame ghi sẵn luôn có độ phân giải đầy đủ"""
+        pass
+        
+    def backlog(self) -> int:
+        """Số frame đã emit nhưng consumer chưa xử lý"""
+        while self._emitted and self._emitted[0] <= self.consumed_seq:
+            self._emitted.popleft()
+        return len(self._emitted) if self.consumed_seq >= 0 else 0
+        
+    def memory_usage(self) -> int:
+        return 0
+        
+    def run(self):
+        cap = cv2.VideoCapture(self.path)
+        if not cap.isOpened():
+            self.error.emit(f"Không mở được stream: {self.path}")
+            return
+            
+        period = 1.0 / (self.fps or cap.get(cv2.CAP_PROP_FPS) or 30.0)
+        self.running = True
+        
+        seq = -1
+        start = time.monotonic()
+        frame_count = 0
+        last_fps_time = start
+        
+        while self.running:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            seq += 1
+            self.actual_resolution = (frame.shape[1], frame.shape[0])
+            
+            # Timestamps follow the recording, not the replay speed
+            timestamp = start + seq * period
+            if self.realtime:
+                delay = timestamp - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                    
+                # Like a camera: frames the consumer cannot take are lost
+                if (self.backlog() > CameraThread.MAX_BACKLOG
+                        or (self.frame_stride > 1 and seq % self.frame_stride)):
+                    self.dropped += 1
+                    continue
+                    
+            self.emitted_seq = seq
+            self._emitted.append(seq)
+            frame_count += 1
+            self.frame_ready.emit(frame, timestamp, seq)
+            
+            now = time.monotonic()
+            if now - last_fps_time >= 1.0:
+                self.decode_fps = frame_count / (now - last_fps_time)
+                frame_count = 0
+                last_fps_time = now
+                
+        self.running = False
+        cap.release()
+        
+    def stop(self):
+        self.running = False
+        self.wait()
+
+
+# ============================================================================
+# SCAN SERVER - Nhiều phiên quét song song, dùng chung worker pool
+# ============================================================================
+
+SERVER_WORKERS = max(2, (os.cpu_count() or 4) // 2)
+SESSION_MAX_QUEUE = 4  # queued tile jobs per session before captures are deferred
+
+
+class ScanWorkerPool:
+    """
+    Worker pool dùng chung cho mọi phiên quét (hiệu chỉnh, registration, export).
+    Job của cùng một phiên chạy tuần tự theo thứ tự gửi (canvas không thread-safe);
+    các phiên được phục vụ xoay vòng nên một phiên bận không chiếm hết worker.
+    Dùng thread vì canvas nằm trong process và OpenCV nhả GIL khi xử lý ảnh.
+    """
+    
+    def __init__(self, workers: int = SERVER_WORKERS, max_queue: int = SESSION_MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._cond = threading.Condition()
+        self._queues = {}      # session -> deque of (future, fn, args, submit time)
+        self._busy = set()     # sessions with a job running
+        self._order = deque()  # round-robin order of sessions
+        self._stats = {}
+        self._running = True
+        self._threads = [threading.Thread(target=self._worker, daemon=True)
+                         for _ in range(workers)]
+        for t in self._threads:
+            t.start()
+            
+    def register(self, name: str):
+        with self._cond:
+            self._queues[name] = deque()
+            self._order.append(name)
+            self._stats[name] = {"submitted": 0, "done": 0, "failed": 0, "deferred": 0,
+                                 "busy_time": 0.0, "wait_time": 0.0}
+            
+    def unregister(self, name: str):
+        """Bỏ phiên; job chưa chạy bị huỷ"""
+        with self._cond:
+            for future, *_ in self._queues.pop(name, ()):
+                future.cancel()
+            if name in self._order:
+                self._order.remove(name)
+            self._stats.pop(name, None)
+            self._cond.notify_all()
+            
+    def submit(self, name: str, fn, *args, block: bool = False, force: bool = False) -> Optional[Future]:
+        """
+        Đưa job vào hàng đợi của phiên. Khi hàng đợi đầy: block=True chờ có chỗ,
+        force=True vẫn nhận, mặc định trả về None (phiên tự thử lại sau).
+        """
+        with self._cond:
+            jobs = self._queues.get(name)
+            if jobs is None or not self._running:
+                return None
+            while len(jobs) >= self.max_queue and not force:
+                if not block:
+                    self._stats[name]["deferred"] += 1
+                    return None
+                self._cond.wait()
+                if self._queues.get(name) is not jobs or not self._running:
+                    return None
+            future = Future()
+            jobs.append((future, fn, args, time.monotonic()))
+            self._stats[name]["submitted"] += 1
+            self._cond.notify_all()
+            return future
+            
+    def pending(self, name: str) -> int:
+        with self._cond:
+            return len(self._queues.get(name, ())) + (name in self._busy)
+            
+    def join(self, name: str, timeout: Optional[float] = None) -> bool:
+        """Chờ mọi job của phiên chạy xong"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._queues.get(name) or name in self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+        
+    def get_stats(self, name: str) -> dict:
+        with self._cond:
+            stats = dict(self._stats.get(name, {}))
+            stats["queued"] = len(self._queues.get(name, ()))
+        return stats
+        
+    def _next(self) -> Optional[str]:
+        """Phiên kế tiếp (xoay vòng) có job chờ và không có job đang chạy"""
+        for _ in range(len(self._order)):
+            name = self._order[0]
+            self._order.rotate(-1)
+            if self._queues[name] and name not in self._busy:
+                return name
+        return None
+        
+    def _worker(self):
+        while True:
+            with self._cond:
+                name = self._next()
+                while name is None:
+                    if not self._running:
+                        return
+                    self._cond.wait()
+                    name = self._next()
+                future, fn, args, submitted = self._queues[name].popleft()
+                self._busy.add(name)
+                # A slot was freed for blocked submitters
+                self._cond.notify_all()
+                
+            t0 = time.monotonic()
+            ok = True
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except Exception as e:
+                    future.set_exception(e)
+                    ok = False
+            t1 = time.monotonic()
+            
+            with self._cond:
+                self._busy.discard(name)
+                stats = self._stats.get(name)
+                if stats is not None:
+                    stats["done" if ok else "failed"] += 1
+                    stats["busy_time"] += t1 - t0
+                    stats["wait_time"] += t0 - submitted
+                self._cond.notify_all()
+                
+    def shutdown(self, wait: bool = True):
+        """Dừng nhận job; các job đã nhận vẫn được chạy hết"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()
+
+
+class ScanSession:
+    """
+    Một pipeline quét độc lập: nguồn frame (CameraThread hoặc ReplayThread),
+    SimpleTracker, ImageCorrector và StitchingCanvas riêng.
+    Tracking chạy trên thread của nguồn; hiệu chỉnh + registration của tile
+    chạy trên ScanWorkerPool dùng chung.
+    """
+    
+    def __init__(self, name: str, source, pool: ScanWorkerPool, capture_interval: int = 15,
+                 archive_path: Optional[str] = None, backpressure: bool = False):
+        self.name = name
+        self.source = source
+        self.pool = pool
+        self.capture_interval = capture_interval
+        self.backpressure = backpressure  # True: wait for the pool instead of deferring captures
+        
+        self.tracker = SimpleTracker()
+        self.corrector = ImageCorrector()
+        self.canvas = StitchingCanvas()
+        self.archive = TileArchive(archive_path) if archive_path else None
+        
+        self.frame_counter = capture_interval  # Capture first tile immediately
+        self.accum_dx = 0.0
+        self.accum_dy = 0.0
+        
+        # Throughput stats
+        self.frames = 0
+        self.dropped_frames = 0
+        self.last_seq = None
+        self.started = None
+        self.errors = []
+        
+        pool.register(name)
+        
+    def start(self):
+        if self.archive:
+            self.archive.open()
+        # Frames are handled on the source thread (no GUI event loop needed)
+        self.source.frame_ready.connect(self.on_frame, Qt.DirectConnection)
+        self.source.error.connect(self.errors.append, Qt.DirectConnection)
+        self.started = time.monotonic()
+        self.source.start()
+        
+    def stop(self):
+        """Dừng nguồn, chờ các tile đang xử lý rồi đóng archive"""
+        self.source.stop()
+        self.pool.join(self.name)
+        if self.archive:
+            self.archive.close()
+            
+    def is_running(self) -> bool:
+        return self.source.isRunning() or self.pool.pending(self.name) > 0
+        
+    def on_frame(self, frame: np.ndarray, timestamp: float, seq: int):
+        self.frames += 1
+        if self.last_seq is not None and seq > self.last_seq + 1:
+            self.dropped_frames += seq - self.last_seq - 1
+        self.last_seq = seq
+        
+        pyramid = FramePyramid(frame)
+        full_size = self.source.actual_resolution
+        if not full_size or full_size[0] <= 0:
+            full_size = (frame.shape[1], frame.shape[0])
+            
+        dx, dy = self.tracker.get_displacement(pyramid, full_size, timestamp)
+        self.accum_dx += dx
+        self.accum_dy += dy
+        
+        self.frame_counter += 1
+        if self.frame_counter >= self.capture_interval:
+            if frame.shape[1] < full_size[0]:
+                # Wait for a full-resolution decode
+                self.source.request_full_frame()
+            elif self.pool.submit(self.name, self._add_tile, frame, self.accum_dx, self.accum_dy,
+                                  block=self.backpressure) is not None:
+                self.accum_dx = 0.0
+                self.accum_dy = 0.0
+                self.frame_counter = 0
+            # Pool queue full: keep accumulating motion, retry on the next frame
+            
+        self.source.consumed_seq = seq
+        
+    def _add_tile(self, raw: np.ndarray, dx: float, dy: float) -> bool:
+        """Chạy trên worker pool (tuần tự trong phiên)"""
+        corrected = self.corrector.correct(raw)
+        added = self.canvas.add_tile(corrected, dx, dy)
+        if added and self.archive:
+            x, y = self.canvas.last_tile_pos
+            self.archive.append(raw, x, y, self.corrector.get_params())
+        return added
+        
+    def _export(self, path: str) -> bool:
+        result = self.canvas.get_canvas()
+        return result is not None and cv2.imwrite(path, result)
+        
+    def export(self, path: str) -> Optional[Future]:
+        """Xuất canvas ra file trên worker pool, sau các tile đã gửi"""
+        return self.pool.submit(self.name, self._export, path, force=True)
+        
+    def get_stats(self) -> dict:
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        pool = self.pool.get_stats(self.name)
+        done = max(pool.get("done", 0) + pool.get("failed", 0), 1)
+        return {
+            "frames": self.frames,
+            "fps": self.frames / elapsed if elapsed > 0 else 0.0,
+            "dropped": self.dropped_frames + self.source.dropped,
+            "tiles": self.canvas.tile_count,
+            "tiles_per_s": self.canvas.tile_count / elapsed if elapsed > 0 else 0.0,
+            "queued": pool.get("queued", 0),
+            "deferred": pool.get("deferred", 0),
+            "failed": pool.get("failed", 0),
+            "busy_time": pool.get("busy_time", 0.0),
+            "job_ms": pool.get("busy_time", 0.0) / done * 1000,
+            "wait_ms": pool.get("wait_time", 0.0) / done * 1000,
+        }
+
+
+class ScanServer:
+    """
+    Quản lý nhiều phiên quét trên một máy: mỗi phiên một camera hoặc một
+    stream phát lại, tất cả dùng chung một ScanWorkerPool.
+    """
+    
+    def __init__(self, workers: int = SERVER_WORKERS, out_dir: Optional[str] = None):
+        self.pool = ScanWorkerPool(workers)
+        self.sessions = OrderedDict()
+        self.out_dir = out_dir or os.getcwd()
+        
+    def add_session(self, name: str, source, capture_interval: int = 15,
+                    archive: bool = False, backpressure: bool = False) -> ScanSession:
+        if name in self.sessions:
+            name = f"{name}_{len(self.sessions)}"
+        archive_path = os.path.join(self.out_dir, f"{name}_tiles") if archive else None
+        session = ScanSession(name, source, self.pool, capture_interval, archive_path, backpressure)
+        self.sessions[name] = session
+        return session
+        
+    def add_camera(self, index: int, resolution: str = "5MP (2560x1920)",
+                   capture_mode: str = "MJPEG (nén, nhanh)", **kwargs) -> ScanSession:
+        device = CameraDiscovery.load().get(index)
+        source = CameraThread(index, resolution, capture_mode,
+                              backend=device["backend"] if device else None)
+        return self.add_session(f"cam{index}", source, **kwargs)
+        
+    def add_replay(self, path: str, realtime: bool = True, fps: Optional[float] = None,
+                   **kwargs) -> ScanSession:
+        # Replays faster than real time wait for the pool instead of skipping tiles
+        kwargs.setdefault("backpressure", not realtime)
+        # Image sequences ("rec/slide1/f_%04d.png") are named after their folder
+        base = path.rstrip("/\\")
+        if "%" in os.path.basename(base):
+            base = os.path.dirname(base)
+        name = os.path.splitext(os.path.basename(base))[0] or "replay"
+        return self.add_session(name, ReplayThread(path, fps, realtime), **kwargs)
+        
+    def remove_session(self, name: str):
+        session = self.sessions.pop(name, None)
+        if session:
+            session.stop()
+            self.pool.unregister(name)
+            
+    def start(self):
+        for session in self.sessions.values():
+            session.start()
+            
+    def stop(self):
+        for session in self.sessions.values():
+            session.stop()
+            
+    def is_running(self) -> bool:
+        return any(s.is_running() for s in self.sessions.values())
+        
+    def export_all(self) -> dict:
+        """Xuất mọi canvas vào out_dir. Trả về {name: (path, Future)}."""
+        os.makedirs(self.out_dir, exist_ok=True)
+        exports = {}
+        for name, session in self.sessions.items():
+            path = os.path.join(self.out_dir, f"{name}.png")
+            exports[name] = (path, session.export(path))
+        return exports
+        
+    def get_stats(self) -> dict:
+        """Thống kê theo phiên, kèm tỉ lệ thời gian worker mỗi phiên đã dùng"""
+        stats = {name: s.get_stats() for name, s in self.sessions.items()}
+        total = sum(s["busy_time"] for s in stats.values())
+        for s in stats.values():
+            s["share"] = s["busy_time"] / total if total > 0 else 0.0
+        return stats
+        
+    def shutdown(self):
+        self.stop()
+        self.pool.shutdown()
+
+
+# ============================================================================
+# CANVAS VIEWER - Xem canvas với zoom / pan
+# ============================================================================
+
+class CanvasViewer(QWidget):
+    """
+    Viewer canvas: lăn chuột để zoom, kéo để pan, double-click để fit.
+    Chỉ vẽ các tile nhìn thấy ở level phù hợp với mức zoom hiện tại.
+    """
+    
+    MIN_ZOOM = 1.0 / (1 << VIEW_MAX_LEVEL)
+    MAX_ZOOM = 8.0
+    FALLBACK_LEVELS = 3  # coarser levels tried while a tile is still loading
+    
+    # Emitted from the tile loader thread (queued to the GUI thread)
+    tile_loaded = pyqtSignal()
+    
+    def __init__(self, canvas: StitchingCanvas, parent=None):
+        super().__init__(parent)
+        self.canvas = canvas
+        self.placeholder = ""
+        self.tile_loaded.connect(self.update)
+        canvas.view_cache.on_loaded = self.tile_loaded.emit
+        
+        self.zoom = 1.0            # screen px per canvas px
+        self.center = (0.0, 0.0)   # canvas point at the widget center
+        self.fit_mode = True       # follow the whole canvas until the user zooms/pans
+        self.show_gaps = True      # overlay uncovered holes from the coverage grid
+        self._gap_overlay = None   # (gaps mask, RGBA image) - rebuilt only when the mask changes
+        self._drag_pos = None
+        
+    def setText(self, text: str):
+        """Hiện thông báo khi canvas trống (giống QLabel)"""
+        self.placeholder = text
+        self.fit_mode = True
+        self.update()
+        
+    def _fit(self):
+        c = self.canvas
+        w, h = c.max_x - c.min_x, c.max_y - c.min_y
+        if w <= 0 or h <= 0:
+            return
+        self.zoom = max(self.MIN_ZOOM, min((self.width() - 10) / w, (self.height() - 10) / h, 1.0))
+        self.center = ((c.min_x + c.max_x) / 2, (c.min_y + c.max_y) / 2)
+        
+    def _to_canvas(self, sx: float, sy: float) -> Tuple[float, float]:
+        return (self.center[0] + (sx - self.width() / 2) / self.zoom,
+                self.center[1] + (sy - self.height() / 2) / self.zoom)
+        
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor("#15161e"))
+        c = self.canvas
+        
+        if c.tile_count == 0:
+            painter.setPen(QColor("#c0caf5"))
+            painter.drawText(self.rect(), Qt.AlignCenter, self.placeholder)
+            return
+            
+        if self.fit_mode:
+            self._fit()
+            
+        # Level whose resolution is just above the current zoom
+        level = 0
+        while level < VIEW_MAX_LEVEL and self.zoom <= 1.0 / (1 << (level + 1)):
+            level += 1
+        cache = c.view_cache
+        ts = cache.tile_size
+        world_ts = ts << level
+        
+        # Visible canvas area, clipped to painted bounds
+        x1, y1 = self._to_canvas(0, 0)
+        x2, y2 = self._to_canvas(self.width(), self.height())
+        x1, y1 = max(x1, c.min_x), max(y1, c.min_y)
+        x2, y2 = min(x2, c.max_x), min(y2, c.max_y)
+        
+        if x2 > x1 and y2 > y1:
+            painter.setRenderHint(QPainter.SmoothPixmapTransform, self.zoom < 1.0)
+            missing = []
+            for ty in range(int(y1 // world_ts), int((y2 - 1) // world_ts) + 1):
+                for tx in range(int(x1 // world_ts), int((x2 - 1) // world_ts) + 1):
+                    sx = (tx * world_ts - self.center[0]) * self.zoom + self.width() / 2
+                    sy = (ty * world_ts - self.center[1]) * self.zoom + self.height() / 2
+                    size = world_ts * self.zoom
+                    
+                    # Only tiles already loaded; never read the stores while painting
+                    tile = cache.peek(level, tx, ty)
+                    source = QRectF(0, 0, ts, ts)
+                    if tile is None:
+                        missing.append((level, tx, ty))
+                        # Stretch the matching part of a coarser tile meanwhile
+                        for d in range(1, self.FALLBACK_LEVELS + 1):
+                            if level + d > VIEW_MAX_LEVEL:
+                                break
+                            tile = cache.peek(level + d, tx >> d, ty >> d)
+                            if tile is not None:
+                                sub = ts / (1 << d)
+                                mask = (1 << d) - 1
+                                source = QRectF((tx & mask) * sub, (ty & mask) * sub, sub, sub)
+                                break
+                    if tile is None:
+                        continue
+                    qimg = QImage(tile.data, ts, ts, 3 * ts, QImage.Format_RGB888).rgbSwapped()
+                    painter.drawImage(QRectF(sx, sy, size, size), qimg, source)
+            cache.request(missing)
+                    
+        # Uncovered holes (one scaled RGBA image over the whole grid)
+        if self.show_gaps:
+            gaps, (ox, oy) = c.coverage.gaps()
+            if self._gap_overlay is None or self._gap_overlay[0] is not gaps:
+                rgba = None
+                if gaps.any():
+                    rgba = np.zeros((*gaps.shape, 4), dtype=np.uint8)
+                    rgba[gaps > 0] = (247, 118, 142, 110)
+                self._gap_overlay = (gaps, rgba)
+            rgba = self._gap_overlay[1]
+            if rgba is not None:
+                gh, gw = rgba.shape[:2]
+                qimg = QImage(rgba.data, gw, gh, 4 * gw, QImage.Format_RGBA8888)
+                cell = c.coverage.cell
+                sx = (ox * cell - self.center[0]) * self.zoom + self.width() / 2
+                sy = (oy * cell - self.center[1]) * self.zoom + self.height() / 2
+                painter.setRenderHint(QPainter.SmoothPixmapTransform, False)
+                painter.drawImage(QRectF(sx, sy, gw * cell * self.zoom, gh * cell * self.zoom), qimg)
+                
+        # Last tile outline (current stage position)
+        tile_gray = c.last_tile_gray
+        if tile_gray is not None:
+            px, py = c.last_tile_pos
+            th, tw = tile_gray.shape[:2]
+            sx = (px - self.center[0]) * self.zoom + self.width() / 2
+            sy = (py - self.center[1]) * self.zoom + self.height() / 2
+            painter.setPen(QPen(QColor("#f7768e"), 2))
+            painter.drawRect(QRectF(sx, sy, tw * self.zoom, th * self.zoom))
+            
+    def wheelEvent(self, event):
+        factor = 1.25 ** (event.angleDelta().y() / 120)
+        new_zoom = max(self.MIN_ZOOM, min(self.zoom * factor, self.MAX_ZOOM))
+        
+        # Keep the canvas point under the cursor fixed
+        pos = event.pos()
+        cx, cy = self._to_canvas(pos.x(), pos.y())
+        self.zoom = new_zoom
+        self.center = (cx - (pos.x() - self.width() / 2) / self.zoom,
+                       cy - (pos.y() - self.height() / 2) / self.zoom)
+        self.fit_mode = False
+        self.update()
+        
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self._drag_pos = event.pos()
+            
+    def mouseMoveEvent(self, event):
+        if self._drag_pos is not None:
+            d = event.pos() - self._drag_pos
+            self._drag_pos = event.pos()
+            self.center = (self.center[0] - d.x() / self.zoom,
+                           self.center[1] - d.y() / self.zoom)
+            self.fit_mode = False
+            self.update()
+            
+    def mouseReleaseEvent(self, event):
+        self._drag_pos = None
+        
+    def mouseDoubleClickEvent(self, event):
+        self.fit_mode = True
+        self.update()
+
+
 # ============================================================================
 # MAIN WINDOW
 # ============================================================================
@@ -516,20 +2330,49 @@ class MainWindow(QMainWindow):
         self.canvas = StitchingCanvas()
         self.tracker = SimpleTracker()
         self.corrector = ImageCorrector()  # Image correction
+        self.archive = None  # Raw tile archive (optional)
         self.camera = None
+        self.probe_thread = None
+        self.devices = CameraDiscovery.load()  # Cached device capabilities
+        
+        # RAM budget: components register usage, policies run in this order
+        self.governor = MemoryGovernor(MEMORY_BUDGET_MB * 1024 * 1024)
+        self.governor.register("canvas", lambda: self.canvas.store.get_stats()["hot_bytes"])
+        self.governor.register("nén", lambda: self.canvas.store.get_stats()["cold_bytes"])
+        self.governor.register("view", self.canvas.view_cache.memory_usage)
+        self.governor.register("coverage", lambda: self.canvas.coverage.grid.nbytes)
+        self.governor.register("archive", lambda: self.archive.pending_bytes if self.archive else 0)
+        self.governor.register("camera", lambda: self.camera.memory_usage() if self.camera else 0)
+        self.governor.register("averager", lambda: self.averager.memory_usage())
+        self.governor.add_policy("shrink view", self.canvas.view_cache.shrink)
+        self.governor.add_policy("evict", self.canvas.store.evict_hot)
+        self.governor.add_policy("spill", self.canvas.store.spill)
+        self.governor.add_policy("drop frames", self.drop_frames)
         
         self.scanning = False
         self.capture_interval = 15  # Capture every N frames
         self.frame_counter = 0
+        self.skip_covered = False   # Skip keyframes over already covered area
+        self.min_new_coverage = 0.1 # Min uncovered fraction for a new tile
+        
+        # Stationary-stage temporal averaging
+        self.averaging = False
+        self.averager = TemporalAverager()
+        self.average_done = False   # already averaged at the current stop
+        self.done_drift = (0.0, 0.0)  # unfiltered drift since that average was flushed
+        self.recent_shifts = deque(maxlen=STILL_FRAMES)
         
         # Accumulated displacement
         self.accum_dx = 0.0
         self.accum_dy = 0.0
         
-        # Stats
+        # Stats (from capture timestamps)
         self.fps_counter = 0
-        self.last_fps_time = time.time()
+        self.fps_first_ts = None
+        self.fps_last_ts = None
         self.fps = 0.0
+        self.last_seq = None
+        self.dropped_frames = 0
         
         self.setup_ui()
         
@@ -583,24 +2426,47 @@ class MainWindow(QMainWindow):
         
         cam_layout.addWidget(QLabel("Camera:"), 0, 0)
         self.cam_combo = QComboBox()
-        self.cam_combo.addItems([f"Camera {i}" for i in range(5)])
         cam_layout.addWidget(self.cam_combo, 0, 1)
         
+        self.probe_btn = QPushButton("🔍")
+        self.probe_btn.setToolTip("Dò lại camera")
+        self.probe_btn.setFixedWidth(40)
+        self.probe_btn.clicked.connect(self.start_probe)
+        cam_layout.addWidget(self.probe_btn, 0, 2)
+        
         cam_layout.addWidget(QLabel("Resolution:"), 1, 0)
         self.res_combo = QComboBox()
-        self.res_combo.addItems(list(CAMERA_RESOLUTIONS.keys()))
-        self.res_combo.setCurrentIndex(0)  # Default: 5MP
-        cam_layout.addWidget(self.res_combo, 1, 1)
+        cam_layout.addWidget(self.res_combo, 1, 1, 1, 2)
+        
+        cam_layout.addWidget(QLabel("Định dạng:"), 2, 0)
+        self.mode_combo = QComboBox()
+        self.mode_combo.addItems(list(CAPTURE_MODES.keys()))
+        self.mode_combo.setCurrentIndex(0)  # Default: MJPEG
+        cam_layout.addWidget(self.mode_combo, 2, 1, 1, 2)
+        
+        self.reduced_cb = QCheckBox("Giải mã thu nhỏ cho preview/tracking")
+        self.reduced_cb.setChecked(True)
+        cam_layout.addWidget(self.reduced_cb, 3, 0, 1, 3)
         
         self.connect_btn = QPushButton("🔌 Kết nối Camera")
         self.connect_btn.setFixedHeight(30)
         self.connect_btn.clicked.connect(self.toggle_camera)
-        cam_layout.addWidget(self.connect_btn, 2, 0, 1, 2)
+        cam_layout.addWidget(self.connect_btn, 4, 0, 1, 3)
         
         # Resolution info label
         self.res_info_label = QLabel("Sensor: CMOS 1/2.8\" | Pixel: 2.0μm")
         self.res_info_label.setStyleSheet("font-size: 10px; color: #7aa2f7;")
-        cam_layout.addWidget(self.res_info_label, 3, 0, 1, 2)
+        cam_layout.addWidget(self.res_info_label, 5, 0, 1, 3)
+        
+        self.res_combo.currentTextChanged.connect(self.update_res_info)
+        self.mode_combo.currentTextChanged.connect(self.populate_resolutions)
+        self.cam_combo.currentIndexChanged.connect(self.populate_resolutions)
+        
+        # Fill from the discovery cache; probe in background if there is none
+        # (or a device timed out last time)
+        self.populate_cameras()
+        if not self.devices or any(info.get("unverified") for info in self.devices.values()):
+            self.start_probe()
         
         left_layout.addWidget(cam_group)
         
@@ -640,6 +2506,10 @@ class MainWindow(QMainWindow):
         self.save_btn.clicked.connect(self.save_result)
         ctrl_layout.addWidget(self.save_btn, 1, 1)
         
+        self.render_btn = QPushButton("🗂 Render lại từ archive")
+        self.render_btn.clicked.connect(self.render_archive)
+        ctrl_layout.addWidget(self.render_btn, 2, 0, 1, 2)
+        
         left_layout.addWidget(ctrl_group)
         
         # Settings
@@ -654,6 +2524,49 @@ class MainWindow(QMainWindow):
         self.interval_spin.valueChanged.connect(lambda v: setattr(self, 'capture_interval', v))
         set_layout.addWidget(self.interval_spin, 0, 1)
         
+        set_layout.addWidget(QLabel("Nén canvas:"), 1, 0)
+        self.codec_combo = QComboBox()
+        self.codec_combo.addItems(list(CANVAS_CODECS.keys()))
+        self.codec_combo.currentTextChanged.connect(
+            lambda t: setattr(self.canvas.store, 'codec', t))
+        set_layout.addWidget(self.codec_combo, 1, 1)
+        
+        self.archive_cb = QCheckBox("Lưu tile gốc (render lại sau)")
+        self.archive_cb.setChecked(False)
+        set_layout.addWidget(self.archive_cb, 2, 0, 1, 2)
+        
+        self.skip_covered_cb = QCheckBox("Bỏ qua tile trùng vùng đã quét")
+        self.skip_covered_cb.setChecked(False)
+        self.skip_covered_cb.stateChanged.connect(
+            lambda s: setattr(self, 'skip_covered', s == Qt.Checked))
+        set_layout.addWidget(self.skip_covered_cb, 3, 0, 1, 2)
+        
+        self.gaps_cb = QCheckBox("Hiện vùng chưa quét (lỗ)")
+        self.gaps_cb.setChecked(True)
+        set_layout.addWidget(self.gaps_cb, 4, 0, 1, 2)
+        
+        set_layout.addWidget(QLabel("RAM budget:"), 5, 0)
+        self.budget_spin = QSpinBox()
+        self.budget_spin.setRange(256, 65536)
+        self.budget_spin.setSingleStep(256)
+        self.budget_spin.setValue(MEMORY_BUDGET_MB)
+        self.budget_spin.setSuffix(" MB")
+        self.budget_spin.valueChanged.connect(
+            lambda v: setattr(self.governor, 'budget', v * 1024 * 1024))
+        set_layout.addWidget(self.budget_spin, 5, 1)
+        
+        self.average_cb = QCheckBox("Trung bình khi đứng yên:")
+        self.average_cb.setChecked(False)
+        self.average_cb.stateChanged.connect(self.toggle_averaging)
+        set_layout.addWidget(self.average_cb, 6, 0)
+        self.average_spin = QSpinBox()
+        self.average_spin.setRange(2, 64)
+        self.average_spin.setValue(self.averager.max_frames)
+        self.average_spin.setSuffix(" frames")
+        self.average_spin.valueChanged.connect(
+            lambda v: setattr(self.averager, 'max_frames', v))
+        set_layout.addWidget(self.average_spin, 6, 1)
+        
         left_layout.addWidget(set_group)
         
         # Image Correction
@@ -727,11 +2640,13 @@ class MainWindow(QMainWindow):
         canvas_group = QGroupBox("🖼️ Canvas - Ghép ảnh tự động")
         canvas_layout = QVBoxLayout(canvas_group)
         
-        self.canvas_label = QLabel("Di chuyển bàn kính để quét")
-        self.canvas_label.setAlignment(Qt.AlignCenter)
-        self.canvas_label.setMinimumSize(750, 620)
-        self.canvas_label.setStyleSheet("background-color: #15161e; border-radius: 6px;")
-        canvas_layout.addWidget(self.canvas_label)
+        # Zoom: mouse wheel | Pan: drag | Fit: double-click
+        self.canvas_view = CanvasViewer(self.canvas)
+        self.canvas_view.setText("Di chuyển bàn kính để quét")
+        self.canvas_view.setMinimumSize(750, 620)
+        self.gaps_cb.stateChanged.connect(
+            lambda s: setattr(self.canvas_view, 'show_gaps', s == Qt.Checked))
+        canvas_layout.addWidget(self.canvas_view)
         
         right_layout.addWidget(canvas_group)
         
@@ -747,6 +2662,63 @@ class MainWindow(QMainWindow):
         self.stat_timer.timeout.connect(self.update_stats)
         self.stat_timer.setInterval(500)
         
+    def populate_cameras(self):
+        """Điền danh sách camera từ kết quả dò (hoặc Camera 0..4 nếu chưa dò)"""
+        self.cam_combo.blockSignals(True)
+        self.cam_combo.clear()
+        if self.devices:
+            for index, info in self.devices.items():
+                if info.get("unverified"):
+                    label = f"Camera {index} (chưa xác minh)"
+                else:
+                    label = f"Camera {index} ({info['backend']}, {len(info['presets'])} preset)"
+                self.cam_combo.addItem(label, index)
+        else:
+            for index in range(5):
+                self.cam_combo.addItem(f"Camera {index}", index)
+        self.cam_combo.blockSignals(False)
+        self.populate_resolutions()
+        
+    def populate_resolutions(self):
+        """Chỉ hiện các preset mà camera đang chọn hỗ trợ ở định dạng đang chọn"""
+        info = self.devices.get(self.cam_combo.currentData())
+        mode = self.mode_combo.currentText()
+        presets = [name for name in CAMERA_RESOLUTIONS
+                   if info and mode in info["presets"].get(name, {})]
+        if not presets or info.get("unverified"):
+            # Not probed, probe timed out or nothing verified in this mode: offer everything
+            presets = list(CAMERA_RESOLUTIONS)
+        current = self.res_combo.currentText()
+        
+        self.res_combo.blockSignals(True)
+        self.res_combo.clear()
+        self.res_combo.addItems(presets)
+        if current in presets:
+            self.res_combo.setCurrentText(current)
+        self.res_combo.blockSignals(False)
+        self.update_res_info()
+        
+    def start_probe(self):
+        if self.probe_thread is not None or self.camera is not None:
+            return
+        self.probe_btn.setEnabled(False)
+        self.cam_combo.setEnabled(False)
+        self.connect_btn.setEnabled(False)
+        self.res_info_label.setText("Đang dò camera...")
+        
+        self.probe_thread = CameraProbeThread()
+        self.probe_thread.devices_ready.connect(self.on_probe_done)
+        self.probe_thread.start()
+        
+    def on_probe_done(self, devices: dict):
+        self.probe_thread.wait()
+        self.probe_thread = None
+        self.devices = devices
+        self.populate_cameras()
+        self.probe_btn.setEnabled(True)
+        self.cam_combo.setEnabled(True)
+        self.connect_btn.setEnabled(True)
+        
     def toggle_camera(self):
         if self.camera is None:
             self.connect_camera()
@@ -755,8 +2727,15 @@ class MainWindow(QMainWindow):
             
     def connect_camera(self):
         resolution = self.res_combo.currentText()
-        self.camera = CameraThread(self.cam_combo.currentIndex(), resolution)
+        index = self.cam_combo.currentData()
+        info = self.devices.get(index)
+        self.camera = CameraThread(index, resolution,
+                                   self.mode_combo.currentText(), self.reduced_cb.isChecked(),
+                                   backend=info["backend"] if info else None)
         self.camera.frame_ready.connect(self.on_frame)
+        self.last_seq = None
+        self.fps_counter = 0
+        self.fps_first_ts = None
         self.camera.error.connect(lambda m: QMessageBox.critical(self, "Lỗi", m))
         self.camera.start()
         
@@ -767,6 +2746,9 @@ class MainWindow(QMainWindow):
         # Disable resolution change while connected
         self.res_combo.setEnabled(False)
         self.cam_combo.setEnabled(False)
+        self.probe_btn.setEnabled(False)
+        self.mode_combo.setEnabled(False)
+        self.reduced_cb.setEnabled(False)
         
         self.canvas_timer.start()
         self.stat_timer.start()
@@ -783,20 +2765,38 @@ class MainWindow(QMainWindow):
         
         # Re-enable resolution change
         self.res_combo.setEnabled(True)
-        self.cam_combo.setEnabled(True)
+        self.cam_combo.setEnabled(self.probe_thread is None)
+        self.probe_btn.setEnabled(self.probe_thread is None)
+        self.mode_combo.setEnabled(True)
+        self.reduced_cb.setEnabled(True)
+        self.update_res_info()
         
         self.canvas_timer.stop()
         self.stat_timer.stop()
         
-    def on_frame(self, frame: np.ndarray):
+    def on_frame(self, frame: np.ndarray, timestamp: float, seq: int):
         """Process camera frame"""
         self.fps_counter += 1
+        if self.fps_first_ts is None:
+            self.fps_first_ts = timestamp
+        self.fps_last_ts = timestamp
+        
+        # Gaps in sequence numbers = frames dropped before reaching us
+        if self.last_seq is not None and seq > self.last_seq + 1:
+            self.dropped_frames += seq - self.last_seq - 1
+        self.last_seq = seq
         
-        # Apply image corrections
-        corrected = self.corrector.correct(frame)
+        # One pyramid per frame, shared by tracker, live view and focus score
+        pyramid = FramePyramid(frame)
+        
+        # Frame may be a reduced (DCT-scaled) decode; tiles need full resolution
+        full_size = self.camera.actual_resolution if self.camera else None
+        if not full_size or full_size[0] <= 0:
+            full_size = (frame.shape[1], frame.shape[0])
+        is_full = frame.shape[1] >= full_size[0]
         
         # Track displacement (use original for better tracking)
-        dx, dy = self.tracker.get_displacement(frame)
+        dx, dy = self.tracker.get_displacement(pyramid, full_size, timestamp)
         self.accum_dx += dx
         self.accum_dy += dy
         
@@ -804,17 +2804,30 @@ class MainWindow(QMainWindow):
         if self.scanning:
             self.frame_counter += 1
             
-            if self.frame_counter >= self.capture_interval:
-                # Add corrected tile with accumulated displacement
-                self.canvas.add_tile(corrected, self.accum_dx, self.accum_dy)
+            due = self.frame_counter >= self.capture_interval
+            if self.averaging and self.average_frame(frame, is_full, dx, dy):
+                # Stage is stationary - frame went into the running average
+                self.frame_counter = 0
+            elif due and self.skip_covered and self.canvas.uncovered_fraction(
+                    self.accum_dx, self.accum_dy, *full_size) < self.min_new_coverage:
+                # Area already scanned - no keyframe, keep accumulating motion
+                self.frame_counter = 0
+            elif due and not is_full:
+                # Wait for a full-resolution decode
+                self.camera.request_full_frame()
+            elif due:
+                self.capture_tile(frame, self.accum_dx, self.accum_dy)
                 
                 # Reset accumulators
                 self.accum_dx = 0.0
                 self.accum_dy = 0.0
                 self.frame_counter = 0
                 
-        # Update live view (show corrected frame)
-        display = cv2.resize(corrected, (340, 255))
+        # Update live view (correct the small pyramid image, not the full frame)
+        small = pyramid.resized(340, 255)
+        display = self.corrector.correct(small)
+        if display is small:
+            display = display.copy()  # pyramid images are shared
         
         # Info overlay
         pos = self.canvas.get_position()
@@ -822,6 +2835,11 @@ class MainWindow(QMainWindow):
                     cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
         cv2.putText(display, f"Tiles: {self.canvas.tile_count}", (5, 40),
                     cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+        cv2.putText(display, f"Focus: {pyramid.focus_score():.0f}", (5, 60),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+        if self.averager.count > 0:
+            cv2.putText(display, f"AVG {self.averager.count}/{self.averager.max_frames}", (5, 80),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 1)
         
         if self.scanning:
             # Progress bar for next capture
@@ -837,37 +2855,182 @@ class MainWindow(QMainWindow):
         qimg = QImage(display.data, w, h, 3 * w, QImage.Format_RGB888).rgbSwapped()
         self.live_label.setPixmap(QPixmap.fromImage(qimg))
         
-    def update_canvas(self):
-        result = self.canvas.get_canvas()
-        if result is not None:
-            h, w = result.shape[:2]
+        # Let the camera skip retrieving frames we could not keep up with
+        if self.camera:
+            self.camera.consumed_seq = seq
+        
+    def capture_tile(self, raw: np.ndarray, dx: float, dy: float):
+        """Hiệu chỉnh, ghép và archive một tile (raw: ảnh gốc độ phân giải đầy đủ)"""
+        # Full-resolution correction only for frames that become tiles
+        corrected = self.corrector.correct(raw)
+        
+        # Add corrected tile with accumulated displacement
+        if self.canvas.add_tile(corrected, dx, dy) and self.archive:
+            # Archive the raw frame with its registered position
+            x, y = self.canvas.last_tile_pos
+            self.archive.append(raw, x, y, self.corrector.get_params())
+        self.enforce_memory()
+        
+    def average_frame(self, frame: np.ndarray, is_full: bool, dx: float, dy: float) -> bool:
+        """
+        Chế độ trung bình khi đứng yên. Trả về True nếu frame được averager
+        giữ lại (không capture tile thường cho frame này).
+        """
+        avg = self.averager
+        shift = self.tracker.last_shift
+        stationary = np.hypot(*shift) <= STATIONARY_PX
+        self.recent_shifts.append(shift)
+        
+        if avg.count > 0:
+            if stationary and not is_full:
+                # Reduced decode still in the pipeline - skip, keep averaging
+                if self.camera:
+                    self.camera.request_full_frame()
+                return True
+            if stationary and avg.add(frame, shift):
+                if avg.is_full():
+                    self.flush_average(0.0, 0.0)
+                    self.average_done = True
+                    self.done_drift = (0.0, 0.0)
+                elif self.camera:
+                    self.camera.request_full_frame()
+                return True
+                
+            # Motion resumed: the average belongs to the position before this frame
+            self.flush_average(dx, dy)
+            self.average_done = True
+            self.done_drift = shift
+            return False
             
-            lw = self.canvas_label.width() - 10
-            lh = self.canvas_label.height() - 10
-            scale = min(lw / w, lh / h, 1.0)
+        if self.average_done:
+            # The stop stays done until the stage has drifted away from it
+            self.done_drift = (self.done_drift[0] + shift[0], self.done_drift[1] + shift[1])
+            if np.hypot(*self.done_drift) <= STATIONARY_PX:
+                # Don't overwrite the average with a single noisy frame;
+                # moving frames still get the normal interval capture
+                return stationary
+            self.average_done = False
+            self.recent_shifts.clear()
+            return False
             
-            if scale < 1.0:
-                result = cv2.resize(result, (int(w * scale), int(h * scale)))
-                h, w = result.shape[:2]
-                
-            qimg = QImage(result.data, w, h, 3 * w, QImage.Format_RGB888).rgbSwapped()
-            self.canvas_label.setPixmap(QPixmap.fromImage(qimg))
+        # Start only once the stage has really stopped (slow scans never qualify)
+        if (len(self.recent_shifts) < STILL_FRAMES
+                or np.hypot(*np.sum(self.recent_shifts, axis=0)) > STATIONARY_PX / 2):
+            return False
+            
+        if is_full:
+            avg.add(frame)
+        if self.camera:
+            self.camera.request_full_frame()
+        return True
+        
+    def flush_average(self, dx: float, dy: float):
+        """
+        Đưa ảnh trung bình vào canvas làm tile.
+        dx, dy: displacement của frame hiện tại (chưa thuộc ảnh trung bình).
+        """
+        averaged = self.averager.result()
+        self.averager.reset()
+        if averaged is None:
+            return
+        self.capture_tile(averaged, self.accum_dx - dx, self.accum_dy - dy)
+        self.accum_dx = dx
+        self.accum_dy = dy
+        
+    def update_canvas(self):
+        self.canvas_view.update()
+        
+    def update_res_info(self):
+        """Hiển thị FPS đã đo cho preset độ phân giải / định dạng đang chọn"""
+        info = "Sensor: CMOS 1/2.8\" | Pixel: 2.0μm"
+        fps = CameraThread.measured_fps.get(
+            (self.res_combo.currentText(), self.mode_combo.currentText()))
+        if fps is None:
+            # Fall back to the FPS measured during discovery
+            device = self.devices.get(self.cam_combo.currentData())
+            modes = device["presets"].get(self.res_combo.currentText(), {}) if device else {}
+            preset = modes.get(self.mode_combo.currentText())
+            fps = preset["measured_fps"] if preset else None
+        if fps is not None:
+            info += f" | Đo: {fps:.1f} fps"
+        self.res_info_label.setText(info)
+        
+    def drop_frames(self, nbytes: int) -> int:
+        """Policy cuối: chỉ nhận 1/2 frame không phải keyframe từ camera"""
+        if self.camera is None or not self.camera.running or self.camera.frame_stride > 1:
+            return 0
+        # Nothing in flight: halving the frame rate would free nothing
+        freed = self.camera.memory_usage() // 2
+        if freed > 0:
+            self.camera.frame_stride = 2
+        return freed
+        
+    def enforce_memory(self):
+        self.governor.enforce()
+        # Restore full frame rate once usage is back under the low-water mark
+        if (self.camera and self.camera.frame_stride > 1
+                and self.governor.total() < self.governor.budget * MemoryGovernor.LOW_WATER):
+            self.camera.frame_stride = 1
             
     def update_stats(self):
-        now = time.time()
-        elapsed = now - self.last_fps_time
-        self.fps = self.fps_counter / elapsed if elapsed > 0 else 0
-        self.fps_counter = 0
-        self.last_fps_time = now
+        # FPS over the capture timestamps received since the last update
+        if self.fps_counter > 1 and self.fps_last_ts > self.fps_first_ts:
+            self.fps = (self.fps_counter - 1) / (self.fps_last_ts - self.fps_first_ts)
+            self.fps_first_ts = self.fps_last_ts
+            self.fps_counter = 1
+        elif self.fps_counter <= 1:
+            self.fps = 0.0
         
         pos = self.canvas.get_position()
-        self.stat_label.setText(
-            f"Tiles: {self.canvas.tile_count}\n"
-            f"Position: ({pos[0]:.0f}, {pos[1]:.0f})\n"
-            f"FPS: {self.fps:.1f}"
-        )
+        mem = self.canvas.get_memory_stats()
+        
+        fps_line = f"FPS: {self.fps:.1f}"
+        if self.camera:
+            fps_line += f" (camera {self.camera.decode_fps:.1f}"
+            fps_line += ", MJPEG pool)" if self.camera.compressed else ")"
+            
+        lines = [
+            f"Tiles: {self.canvas.tile_count}",
+            f"Position: ({pos[0]:.0f}, {pos[1]:.0f})",
+            fps_line,
+            f"Dropped: {self.dropped_frames}"
+            + (f" (camera {self.camera.dropped})" if self.camera else ""),
+            f"Speed: ({self.tracker.velocity[0]:.0f}, {self.tracker.velocity[1]:.0f}) px/s",
+            f"Canvas blocks: {mem['hot_blocks']}/{mem['blocks']} hot",
+            f"Nén: {mem['ratio']:.1f}x, spill: {mem['spilled_bytes'] / 2**20:.0f} MB",
+        ]
+        
+        # RAM per component
+        self.enforce_memory()
+        usage = self.governor.usage()
+        lines.append(f"RAM: {sum(usage.values()) / 2**20:.0f}/{self.governor.budget / 2**20:.0f} MB"
+                     + (" ⚠ " + ", ".join(self.governor.last_actions) if self.governor.last_actions else ""))
+        items = [f"{name} {size / 2**20:.0f}" for name, size in usage.items()]
+        for i in range(0, len(items), 3):
+            lines.append("  " + " | ".join(items[i:i+3]))
+        cov = self.canvas.coverage
+        gaps, _ = cov.gaps()
+        lines.append(f"Phủ: {cov.covered_cells * cov.cell ** 2 / 1e6:.1f} MP, lỗ: {int(gaps.sum())} ô")
+        if self.archive:
+            lines.append(f"Archive: {self.archive.tile_count} tiles ({self.archive.pending} chờ ghi)")
+        self.stat_label.setText("\n".join(lines))
+        
+    def toggle_averaging(self, state):
+        self.averaging = state == Qt.Checked
+        if not self.averaging:
+            # Keep what was averaged so far, then free the accumulator
+            if self.scanning:
+                self.flush_average(0.0, 0.0)
+            self.averager.release()
+        self.average_done = False
+        self.recent_shifts.clear()
         
     def start_scan(self):
+        if self.archive_cb.isChecked() and self.archive is None:
+            self.archive = TileArchive(os.path.join(
+                os.getcwd(), f"scan_{time.strftime('%Y%m%d_%H%M%S')}_tiles"))
+            self.archive.open()
+            
         self.scanning = True
         self.frame_counter = self.capture_interval  # Capture first tile immediately
         self.accum_dx = 0.0
@@ -876,17 +3039,29 @@ class MainWindow(QMainWindow):
         self.stop_btn.setEnabled(True)
         
     def stop_scan(self):
+        self.flush_average(0.0, 0.0)
+        self.average_done = False
+        self.recent_shifts.clear()
         self.scanning = False
         self.start_btn.setEnabled(True)
         self.stop_btn.setEnabled(False)
         
+    def close_archive(self):
+        if self.archive:
+            self.archive.close()
+            self.archive = None
+            
     def reset_all(self):
+        self.close_archive()
         self.canvas.reset()
         self.tracker.reset()
+        self.averager.reset()
+        self.average_done = False
+        self.recent_shifts.clear()
         self.accum_dx = 0.0
         self.accum_dy = 0.0
         self.frame_counter = 0
-        self.canvas_label.setText("Di chuyển bàn kính để quét")
+        self.canvas_view.setText("Di chuyển bàn kính để quét")
         
     def save_result(self):
         result = self.canvas.get_canvas()
@@ -901,12 +3076,92 @@ class MainWindow(QMainWindow):
             cv2.imwrite(path, result)
             QMessageBox.information(self, "OK", f"Đã lưu: {path}")
             
+    def render_archive(self):
+        """Render lại slide từ archive với hiệu chỉnh hiện tại"""
+        folder = QFileDialog.getExistingDirectory(self, "Chọn archive", os.getcwd())
+        if not folder:
+            return
+            
+        archive = TileArchive(folder)
+        if archive.get_bounds() is None:
+            QMessageBox.warning(self, "Cảnh báo", "Archive không có tile!")
+            return
+            
+        zoom, ok = QInputDialog.getItem(
+            self, "Render", "Tỉ lệ:", ["100%", "50%", "25%", "12.5%"], 0, False)
+        if not ok:
+            return
+            
+        path, _ = QFileDialog.getSaveFileName(
+            self, "Lưu", f"render_{time.strftime('%H%M%S')}.png", "PNG (*.png)"
+        )
+        if path:
+            result = archive.render(scale=float(zoom.rstrip("%")) / 100.0,
+                                    corrections=self.corrector.get_params())
+            cv2.imwrite(path, result)
+            QMessageBox.information(self, "OK", f"Đã lưu: {path}")
+            
     def closeEvent(self, event):
         self.disconnect_camera()
+        if self.probe_thread:
+            self.probe_thread.wait()
+        self.close_archive()
         event.accept()
 
 
+def serve(argv: list):
+    """
+    Chế độ server không giao diện, nhiều kính hiển vi trên một máy:
+        python pathocam_scanner.py --serve 0 1 rec/slide1.avi --out scans
+    Nguồn là số (camera index) hoặc file video / chuỗi ảnh đã ghi.
+    """
+    parser = argparse.ArgumentParser(prog="pathocam_scanner.py --serve")
+    parser.add_argument("sources", nargs="+", help="camera index hoặc stream đã ghi")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="số worker dùng chung")
+    parser.add_argument("--interval", type=int, default=15, help="capture mỗi N frame")
+    parser.add_argument("--out", default=os.getcwd(), help="thư mục lưu kết quả")
+    parser.add_argument("--archive", action="store_true", help="lưu tile gốc cho mỗi phiên")
+    parser.add_argument("--fast", action="store_true", help="phát lại nhanh nhất có thể")
+    parser.add_argument("--duration", type=float, default=0.0, help="giây (0: tới khi hết stream / Ctrl+C)")
+    args = parser.parse_args(argv)
+    
+    server = ScanServer(args.workers, args.out)
+    for source in args.sources:
+        if source.isdigit():
+            server.add_camera(int(source), capture_interval=args.interval, archive=args.archive)
+        else:
+            server.add_replay(source, realtime=not args.fast,
+                              capture_interval=args.interval, archive=args.archive)
+            
+    server.start()
+    deadline = time.monotonic() + args.duration if args.duration > 0 else None
+    last_report = time.monotonic()
+    try:
+        while server.is_running() and (deadline is None or time.monotonic() < deadline):
+            time.sleep(0.2)
+            if time.monotonic() - last_report >= 5.0:
+                last_report = time.monotonic()
+                for name, st in server.get_stats().items():
+                    print(f"{name}: {st['fps']:.1f} fps, {st['tiles']} tiles, "
+                          f"hàng đợi {st['queued']}, job {st['job_ms']:.0f} ms, "
+                          f"chờ {st['wait_ms']:.0f} ms, worker {st['share'] * 100:.0f}%, "
+                          f"bỏ {st['dropped']} frame / {st['deferred']} tile")
+    except KeyboardInterrupt:
+        pass
+        
+    server.stop()
+    for name, (path, future) in server.export_all().items():
+        ok = future is not None and future.result()
+        print(f"{name}: {server.sessions[name].canvas.tile_count} tiles -> "
+              + (path if ok else "không có dữ liệu"))
+    server.shutdown()
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        serve(sys.argv[2:])
+        return
+        
     app = QApplication(sys.argv)
     app.setStyle('Fusion')
     window = MainWindow()